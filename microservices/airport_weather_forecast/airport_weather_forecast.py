@@ -4,6 +4,8 @@ import json
 
 import requests
 
+from microservices.utils.metrics import upstream_hooks
+
 
 def forcast(city: str, country: str):
 
@@ -28,7 +30,7 @@ def forcast(city: str, country: str):
         "timezone": "auto"
     }
 
-    resp = requests.get(weather_url, params=params) # get response from api, which should be the forecast
+    resp = requests.get(weather_url, params=params, hooks=upstream_hooks("open_meteo_forecast")) # get response from api, which should be the forecast
     resp.raise_for_status() # throw exception if HTTP fails
 
     return resp.json()
@@ -45,7 +47,7 @@ def _get_coords(city: str, country: str):
         "country": country
     }
     
-    response = requests.get(url, params=params) # get response from api, which should be the coordinates
+    response = requests.get(url, params=params, hooks=upstream_hooks("open_meteo_geocoding")) # get response from api, which should be the coordinates
     response.raise_for_status() # throw exception if HTTP fails
 
     results = response.json().get("results") # get the results from the returned JSON
@@ -16,6 +16,8 @@ from microservices.utils.registry_client import (
     deregister_from_registry,
     health_response,
 )
+from microservices.utils.metrics import service_metrics, instrument_app
+from microservices.utils.profiling import service_profiler, profile_guard, install_profiler
 
 SERVICE_NAME = "airport_weather_forecast"
 SERVICE_DESCRIPTION = (
@@ -25,6 +27,8 @@ SERVICE_DESCRIPTION = (
 SERVICE_URL = os.getenv("SERVICE_URL", "http://localhost:8088")
 
 app = Flask(__name__, static_folder='./frontend/build', static_url_path='/')
+instrument_app(app, service_metrics)
+install_profiler(app, service_profiler, profile_guard)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(SERVICE_NAME)
 
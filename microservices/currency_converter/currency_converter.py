@@ -5,6 +5,8 @@ import logging
 import requests
 from ratelimit import limits, RateLimitException
 
+from microservices.utils.metrics import upstream_hooks
+
 EXCHANGE_API_URL = os.getenv(
     "EXCHANGE_API_URL",
     "https://api.apilayer.com/exchangerates_data/convert",
@@ -27,6 +29,7 @@ def call_exchange_api(headers: dict, params: dict) -> requests.Response:
         headers=headers,
         params=params,
         timeout=5,
+        hooks=upstream_hooks("exchange_api"),
     )
 
 
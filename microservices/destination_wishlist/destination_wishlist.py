@@ -2,6 +2,8 @@ import logging
 import requests
 from ratelimit import limits, RateLimitException
 
+from microservices.utils.metrics import upstream_hooks
+
 logger = logging.getLogger(__name__)
 
 WIKI_SUMMARY_URL = "https://en.wikipedia.org/api/rest_v1/page/summary/{title}"
@@ -9,7 +11,7 @@ WIKI_SUMMARY_URL = "https://en.wikipedia.org/api/rest_v1/page/summary/{title}"
 ONE_HOUR = 3600
 @limits(calls=5, period=ONE_HOUR)
 def call_wiki_api(url: str, headers: dict) -> requests.Response:
-    return requests.get(url, headers=headers, timeout=5)
+    return requests.get(url, headers=headers, timeout=5, hooks=upstream_hooks("wikipedia"))
 
 class DestinationError(Exception):
     pass
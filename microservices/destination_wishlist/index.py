@@ -11,6 +11,8 @@ from microservices.utils.registry_client import (
     deregister_from_registry,
     health_response,
 )
+from microservices.utils.metrics import service_metrics, instrument_app
+from microservices.utils.profiling import service_profiler, profile_guard, install_profiler
 
 from microservices.destination_wishlist.destination_wishlist import (
     get_destination_description,
@@ -29,6 +31,8 @@ logging.basicConfig(
 logger = logging.getLogger(SERVICE_NAME)
 
 app = Flask(__name__, static_folder="./static", static_url_path="/")
+instrument_app(app, service_metrics)
+install_profiler(app, service_profiler, profile_guard)
 
 
 @app.route("/", methods=["GET"])
@@ -5,6 +5,8 @@ import logging
 import requests
 from ratelimit import limits
 
+from microservices.utils.metrics import upstream_hooks
+
 # Configure logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,7 +28,7 @@ def get_nearby_flights():
         # ADSB.lol API endpoint: /v2/lat/{lat}/lon/{lon}/dist/{dist}
         url = f"{ADSB_API_BASE}/lat/{WESTERN_U_LAT}/lon/{WESTERN_U_LON}/dist/{RADIUS_KM}"
         
-        response = requests.get(url, timeout=10)
+        response = requests.get(url, timeout=10, hooks=upstream_hooks("adsb"))
         response.raise_for_status()
         
         data = response.json()
@@ -66,7 +68,7 @@ def search_flight(callsign: str):
         # ADSB.lol API endpoint: /v2/callsign/{callsign}
         url = f"{ADSB_API_BASE}/callsign/{callsign}"
         
-        response = requests.get(url, timeout=10)
+        response = requests.get(url, timeout=10, hooks=upstream_hooks("adsb"))
         response.raise_for_status()
         
         data = response.json()
@@ -0,0 +1,23 @@
+# The collector is registry/metrics.py, the one module shared with the
+# registry and the load balancer, which the Dockerfiles copy into the image
+from registry.metrics import MetricsRegistry, instrument_app
+from microservices.utils.profiling import service_profiler
+
+
+# A microservice runs as a single process, so its registry needs no directory
+service_metrics = MetricsRegistry()
+upstream_seconds = service_metrics.histogram(
+    "upstream_request_duration_seconds",
+    "Latency of calls to upstream APIs and the registry",
+    ["upstream", "status"]
+)
+
+
+def upstream_hooks(upstream):
+    # Pass as hooks= to a requests call to record its latency, also in the
+    # breakdown of a profiled request
+    def observe(response, *args, **kwargs):
+        seconds = response.elapsed.total_seconds()
+        upstream_seconds.observe(seconds, upstream, str(response.status_code))
+        service_profiler.record(f"upstream.{upstream}", seconds)
+    return {"response": observe}
@@ -0,0 +1,18 @@
+import os
+
+# The profiler is registry/profiling.py, shared with the registry, which
+# the Dockerfiles copy into the image
+from registry.profiling import Profiler, token_guard, install_profiler
+
+
+# A microservice runs as a single process, so its profiles stay in memory.
+# Profiling is off unless a sample rate, slow threshold or debug token is set.
+service_profiler = Profiler(
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    slow_threshold=float(os.getenv("PROFILE_SLOW_THRESHOLD", "0")),
+    token=os.getenv("PROFILE_TOKEN"),
+    interval=float(os.getenv("PROFILE_INTERVAL", "0.005")),
+    buffer_size=int(os.getenv("PROFILE_BUFFER_SIZE", "100")),
+)
+# The admin endpoints take PROFILE_TOKEN as a bearer token
+profile_guard = token_guard(service_profiler.token)
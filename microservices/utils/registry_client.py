@@ -1,27 +1,112 @@
 import os
+import json
+import time
+import base64
+import random
 import logging
-from typing import Optional, Tuple
+import threading
+from typing import List, Optional, Tuple
 
 import requests
 
+from microservices.utils.metrics import upstream_hooks
+
 REGISTRY_BASE_URL = os.getenv("REGISTRY_BASE_URL", "http://host.docker.internal:7993")
 REGISTRY_LOGIN_PATH = os.getenv("REGISTRY_LOGIN_PATH", "/login")
+REGISTRY_REFRESH_PATH = os.getenv("REGISTRY_REFRESH_PATH", "/login/refresh")
 REGISTRY_REGISTER_PATH = os.getenv("REGISTRY_REGISTER_PATH", "/services")
 REGISTRY_DEREGISTER_PATH = os.getenv("REGISTRY_DEREGISTER_PATH", "/services")
+REGISTRY_HEARTBEAT_PATH = os.getenv("REGISTRY_HEARTBEAT_PATH", "/services/heartbeat")
+REGISTRY_RESOLVE_PATH = os.getenv("REGISTRY_RESOLVE_PATH", "/services/{name}/instances")
+
+# Lease TTL in seconds; 0 keeps the registry health-checking this service
+REGISTRY_LEASE_TTL = int(os.getenv("REGISTRY_LEASE_TTL", "0"))
 
 REGISTRY_ADMIN_USER = os.getenv("REGISTRY_ADMIN_USER", "admin")
 REGISTRY_ADMIN_PASSWORD = os.getenv("REGISTRY_ADMIN_PASSWORD", "ADMIN")
 
+# Cached tokens are renewed once they are this close to expiring
+REGISTRY_TOKEN_REFRESH_MARGIN = float(os.getenv("REGISTRY_TOKEN_REFRESH_MARGIN", "30"))
+
+# Records the latency of every registry call in upstream_request_duration_seconds
+REGISTRY_HOOKS = upstream_hooks("registry")
+
 SERVICE_ID: Optional[str] = None
 DEREGISTERED: bool = False
 
+_heartbeat_thread: Optional[threading.Thread] = None
+_heartbeat_stop = threading.Event()
+
 logger = logging.getLogger("registry-client")
 
 def _build_url(base: str, path: str) -> str:
     return f"{base.rstrip('/')}{path}"
 
 
-def get_registry_token() -> Optional[str]:
+def _token_expiry(token: str) -> float:
+    # Only reads the exp claim; the registry is the one that verifies tokens
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload)).get("exp", 0))
+    except Exception:
+        return 0.0
+
+
+def _refresh_token(token: str) -> Optional[str]:
+    refresh_url = _build_url(REGISTRY_BASE_URL, REGISTRY_REFRESH_PATH)
+    try:
+        resp = requests.post(
+            refresh_url,
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=5,
+            hooks=REGISTRY_HOOKS,
+        )
+        if resp.status_code != 200:
+            logger.warning("Registry token refresh failed: %s", resp.status_code)
+            return None
+        return resp.json().get("token")
+    except Exception as e:
+        logger.warning("Error calling registry token refresh endpoint: %s", e)
+        return None
+
+
+class _TokenCache:
+    # One token shared by every thread. It is renewed through the cheap
+    # refresh endpoint shortly before it expires and only falls back to a
+    # full (bcrypt-verified) login when that is not possible.
+    def __init__(self, login=None):
+        self._login = login
+        self._lock = threading.Lock()
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+
+    def set(self, token: Optional[str]) -> None:
+        with self._lock:
+            self._token = token
+            self._expires_at = _token_expiry(token) if token else 0.0
+
+    def invalidate(self) -> None:
+        self.set(None)
+
+    def get(self) -> Optional[str]:
+        with self._lock:
+            now = time.time()
+            if self._token and now < self._expires_at - REGISTRY_TOKEN_REFRESH_MARGIN:
+                return self._token
+
+            token = None
+            if self._token and now < self._expires_at:
+                token = _refresh_token(self._token)
+            if token is None and self._login is not None:
+                token = self._login()
+
+            self._token = token
+            self._expires_at = _token_expiry(token) if token else 0.0
+            return token
+
+
+def _login_for_token() -> Optional[str]:
     login_url = _build_url(REGISTRY_BASE_URL, REGISTRY_LOGIN_PATH)
     payload = {
         "username": REGISTRY_ADMIN_USER,
@@ -29,7 +114,7 @@ def get_registry_token() -> Optional[str]:
     }
 
     try:
-        resp = requests.post(login_url, json=payload, timeout=5)
+        resp = requests.post(login_url, json=payload, timeout=5, hooks=REGISTRY_HOOKS)
         if resp.status_code != 200:
             logger.error("Registry login failed: %s %s", resp.status_code, resp.text)
             return None
@@ -47,13 +132,32 @@ def get_registry_token() -> Optional[str]:
         return None
 
 
+_admin_tokens = _TokenCache(login=_login_for_token)
+_service_tokens = _TokenCache()
+
+
+def get_registry_token() -> Optional[str]:
+    return _admin_tokens.get()
+
+
+def _service_token() -> Optional[str]:
+    # Prefer the service's own long-lived credential over the admin login
+    return _service_tokens.get() or get_registry_token()
+
+
 def register_with_registry(
     service_name: str,
     service_description: str,
     service_url: str,
+    lease_ttl: Optional[int] = None,
+    metadata: Optional[dict] = None,
 ) -> Optional[str]:
+    # metadata may carry instance "weight", "zone", "version" and "tags"
     global SERVICE_ID
 
+    if lease_ttl is None:
+        lease_ttl = REGISTRY_LEASE_TTL or None
+
     token = get_registry_token()
     if not token:
         logger.error("Skipping registration - could not obtain registry token")
@@ -68,11 +172,19 @@ def register_with_registry(
         "description": service_description,
         "url": service_url,
     }
+    if lease_ttl:
+        payload["ttl"] = lease_ttl
+    if metadata:
+        payload.update(metadata)
 
     register_url = _build_url(REGISTRY_BASE_URL, REGISTRY_REGISTER_PATH)
 
     try:
-        resp = requests.post(register_url, json=payload, headers=headers, timeout=5)
+        resp = requests.post(
+            register_url, json=payload, headers=headers, timeout=5, hooks=REGISTRY_HOOKS
+        )
+        if resp.status_code == 401:
+            _admin_tokens.invalidate()
         if resp.status_code not in (200, 201):
             logger.error(
                 "Registry registration failed: %s %s",
@@ -83,12 +195,18 @@ def register_with_registry(
 
         data = resp.json() if resp.content else {}
         SERVICE_ID = data.get("UUID")
+        _service_tokens.set(data.get("token"))
 
         logger.info(
             "Successfully registered with registry. Service ID: %s",
             SERVICE_ID,
         )
 
+        if lease_ttl:
+            _start_heartbeat(
+                service_name, service_description, service_url, lease_ttl, metadata
+            )
+
         return SERVICE_ID
 
     except Exception as e:
@@ -96,9 +214,88 @@ def register_with_registry(
         return None
 
 
+def _send_heartbeat(token: str) -> int:
+    heartbeat_url = _build_url(REGISTRY_BASE_URL, REGISTRY_HEARTBEAT_PATH)
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+    resp = requests.put(
+        heartbeat_url,
+        json={"id": SERVICE_ID},
+        headers=headers,
+        timeout=5,
+        hooks=REGISTRY_HOOKS,
+    )
+    return resp.status_code
+
+
+def _heartbeat_loop(
+    service_name: str,
+    service_description: str,
+    service_url: str,
+    lease_ttl: int,
+    metadata: Optional[dict],
+) -> None:
+    # Renew three times per TTL so a single lost heartbeat never expires the lease
+    interval = max(lease_ttl / 3.0, 1.0)
+
+    while not _heartbeat_stop.wait(interval):
+        try:
+            token = _service_token()
+            if not token:
+                continue
+
+            status = _send_heartbeat(token)
+            if status == 401:
+                _service_tokens.invalidate()
+                _admin_tokens.invalidate()
+                token = _service_token()
+                if token:
+                    status = _send_heartbeat(token)
+
+            if status == 404:
+                logger.warning(
+                    "Registry lease for service %s lapsed; re-registering.",
+                    SERVICE_ID,
+                )
+                register_with_registry(
+                    service_name, service_description, service_url, lease_ttl, metadata
+                )
+            elif status != 200:
+                logger.error("Registry heartbeat failed: %s", status)
+
+        except Exception as e:
+            logger.error("Error calling registry heartbeat endpoint: %s", e)
+
+
+def _start_heartbeat(
+    service_name: str,
+    service_description: str,
+    service_url: str,
+    lease_ttl: int,
+    metadata: Optional[dict],
+) -> None:
+    global _heartbeat_thread
+
+    if _heartbeat_thread is not None and _heartbeat_thread.is_alive():
+        return
+
+    _heartbeat_stop.clear()
+    _heartbeat_thread = threading.Thread(
+        target=_heartbeat_loop,
+        args=(service_name, service_description, service_url, lease_ttl, metadata),
+        name="registry-heartbeat",
+        daemon=True,
+    )
+    _heartbeat_thread.start()
+
+
 def deregister_from_registry() -> None:
     global SERVICE_ID, DEREGISTERED
 
+    _heartbeat_stop.set()
+
     if DEREGISTERED:
         logger.info("Deregistration already performed; skipping.")
         return
@@ -107,7 +304,7 @@ def deregister_from_registry() -> None:
         logger.info("No SERVICE_ID set, skipping deregistration.")
         return
 
-    token = get_registry_token()
+    token = _service_token()
     if not token:
         logger.error("Could not obtain registry token for deregistration; skipping.")
         return
@@ -126,6 +323,7 @@ def deregister_from_registry() -> None:
             headers=headers,
             json=payload,
             timeout=5,
+            hooks=REGISTRY_HOOKS,
         )
 
         if resp.status_code in (200, 204):
@@ -154,5 +352,40 @@ def deregister_from_registry() -> None:
         logger.error("Error calling registry deregister endpoint: %s", e)
 
 
+def resolve_service(
+    service_name: str,
+    zone: Optional[str] = None,
+    tags: Optional[List[str]] = None,
+) -> List[dict]:
+    resolve_url = _build_url(
+        REGISTRY_BASE_URL, REGISTRY_RESOLVE_PATH.format(name=service_name)
+    )
+    params = {"zone": zone} if zone else {}
+    if tags:
+        params["tag"] = tags
+
+    try:
+        resp = requests.get(resolve_url, params=params, timeout=5, hooks=REGISTRY_HOOKS)
+        if resp.status_code != 200:
+            logger.error("Registry resolve failed: %s %s", resp.status_code, resp.text)
+            return []
+        return resp.json().get("instances", [])
+
+    except Exception as e:
+        logger.error("Error calling registry resolve endpoint: %s", e)
+        return []
+
+
+def choose_instance(instances: List[dict]) -> Optional[dict]:
+    # Weighted random pick; instances with weight 0 only receive traffic
+    # when nothing else is available
+    weighted = [instance for instance in instances if instance.get("weight", 1) > 0]
+    if not weighted:
+        return random.choice(instances) if instances else None
+    return random.choices(
+        weighted, weights=[instance.get("weight", 1) for instance in weighted]
+    )[0]
+
+
 def health_response(service_name: str) -> Tuple[dict, int]:
     return {"status": "ok", "service": service_name}, 200
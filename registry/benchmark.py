@@ -0,0 +1,508 @@
+# Load test and benchmark harness for the registry.
+#
+# For every catalog size it seeds a throwaway SQLite database, starts the
+# registry under gunicorn against it and points every service at fake
+# microservices served from this process. It then drives the HTTP endpoints
+# and health sweeps at each concurrency level and prints a JSON report with
+# throughput and p50/p95/p99 latencies.
+#
+#   python benchmark.py --sizes 100,1000,10000 --concurrency 1,16,64
+#   python benchmark.py --save-baseline benchmarks/baseline.json
+#   python benchmark.py --baseline benchmarks/baseline.json   # exit 1 on regression
+#   python benchmark.py --target http://localhost:7993 --scenarios catalog,resolve
+import argparse
+import asyncio
+import http.client
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlsplit
+
+import jwt
+from dotenv import dotenv_values
+
+from health_checker import HealthChecker
+from sqlite_storage import SQLiteStorage
+
+REGISTRY_DIR = os.path.dirname(os.path.abspath(__file__))
+READ_SCENARIOS = ('catalog', 'catalog_not_modified', 'filtered', 'resolve')
+SCENARIOS = READ_SCENARIOS + ('health_sweep', 'register', 'deregister')
+# Instances per logical service name in the seeded catalog
+INSTANCES_PER_SERVICE = 10
+SEED_BATCH = 500
+
+logger = logging.getLogger("benchmark")
+
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    if not ordered:
+        return {'mean': None, 'p50': None, 'p95': None, 'p99': None, 'max': None}
+    return {
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': round(percentile(ordered, 50) * 1000, 3),
+        'p95': round(percentile(ordered, 95) * 1000, 3),
+        'p99': round(percentile(ordered, 99) * 1000, 3),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+class FakeServices(object):
+    # Every fake microservice is a URL path on one asyncio server that listens
+    # on several loopback addresses, so the prober sees many distinct hosts.
+    # GET .../health answers 200, or 503 under /fail/.
+    def __init__(self, hosts):
+        self.hosts = [f'127.0.0.{i + 2}' for i in range(hosts)]
+        self.port = free_port()
+        self.requests = 0
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='fake-services', daemon=True).start()
+        self._started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(
+            asyncio.start_server(self._handle, host=self.hosts, port=self.port, backlog=1024)
+        )
+        self._started.set()
+        self._loop.run_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self.requests += 1
+                status = b'503 Service Unavailable' if b' /fail/' in request_line else b'200 OK'
+                writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nok')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def url(self, index, failing=False):
+        host = self.hosts[index % len(self.hosts)]
+        return f"http://{host}:{self.port}/{'fail' if failing else 'ok'}/{index}/"
+
+
+def seed_catalog(path, size, fake_services, fail_ratio):
+    storage = SQLiteStorage(path)
+    # Seeded credentials are never used to log in, so one hash serves all
+    password_hash = '$2b$12$' + 'x' * 53
+    failing_every = int(1 / fail_ratio) if fail_ratio > 0 else 0
+    start = time.monotonic()
+    for offset in range(0, size, SEED_BATCH):
+        registrations = []
+        for index in range(offset, min(size, offset + SEED_BATCH)):
+            registrations.append({
+                'id': str(uuid.uuid4()),
+                'name': f'svc-{index // INSTANCES_PER_SERVICE}',
+                'description': f'benchmark service {index}',
+                'url': fake_services.url(index, failing=bool(failing_every) and index % failing_every == 0),
+                'ttl': None,
+                'weight': 100,
+                'zone': f'zone-{index % 3}',
+                'version': None,
+                'tags': ['bench'],
+            })
+        storage.register_services(registrations, [password_hash] * len(registrations))
+    logger.info(f"seeded {size} services in {time.monotonic() - start:.1f}s")
+    return storage
+
+
+class RegistryServer(object):
+    # The registry under gunicorn, exactly as deployed, against the SQLite file
+    def __init__(self, db_path, workers, threads, workdir):
+        self.port = free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        env = dict(
+            os.environ,
+            STORAGE_BACKEND='sqlite',
+            SQLITE_PATH=db_path,
+            LEADER_ELECTION='file',
+            LEADER_LOCK_FILE=os.path.join(workdir, 'leader.lock'),
+            CATALOG_SNAPSHOT_PATH=os.path.join(workdir, 'catalog.snapshot'),
+            CATALOG_SHARED_DIR=os.path.join(workdir, 'shared_catalog'),
+            METRICS_DIR=os.path.join(workdir, 'metrics'),
+            PROFILE_DIR=os.path.join(workdir, 'profiles'),
+            HEALTH_STATS_PATH=os.path.join(workdir, 'health_stats.json'),
+            GUNICORN_THREADS=str(threads),
+            # Background jobs would compete with the measured requests
+            HEALTH_CHECK_INTERVAL='86400',
+            LEASE_SWEEP_INTERVAL='86400',
+            CHANGE_LOG_COMPACT_INTERVAL='86400',
+            USER_COMPACT_INTERVAL='86400',
+            CATALOG_SNAPSHOT_INTERVAL='86400',
+        )
+        self._log = open(os.path.join(workdir, 'gunicorn.log'), 'wb')
+        self._process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py',
+                '--bind', f'127.0.0.1:{self.port}', '--workers', str(workers), 'index:app'
+            ],
+            cwd=REGISTRY_DIR,
+            env=env,
+            stdout=self._log,
+            stderr=subprocess.STDOUT
+        )
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with {self._process.returncode}, see {self._log.name}")
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=1)
+                conn.request('GET', '/stats/pool')
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"registry did not start within {timeout}s, see {self._log.name}")
+
+    def stop(self):
+        self._process.terminate()
+        try:
+            self._process.wait(10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._log.close()
+
+
+class HttpDriver(object):
+    # Closed-loop load: `concurrency` threads, each with one keep-alive
+    # connection, issue requests back to back until `requests` have been sent
+    def __init__(self, base_url, timeout=30):
+        target = urlsplit(base_url)
+        self.host = target.hostname
+        self.port = target.port or 80
+        self.prefix = target.path.rstrip('/')
+        self.timeout = timeout
+
+    def fetch(self, path):
+        # One untimed request, returns (body, response)
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', self.prefix + path)
+            response = conn.getresponse()
+            return response.read(), response
+        finally:
+            conn.close()
+
+    def run(self, concurrency, requests, make_request):
+        # make_request(i) -> (method, path, body, headers, expected statuses,
+        # callback or None); the callback gets the parsed JSON response
+        counter = itertools.count()
+        latencies = []
+        errors = []
+
+        def worker():
+            conn = None
+            local_latencies = []
+            local_errors = 0
+            while True:
+                i = next(counter)
+                if i >= requests:
+                    break
+                method, path, body, headers, expected, callback = make_request(i)
+                payload = json.dumps(body).encode('utf-8') if body is not None else None
+                headers = dict(headers or {})
+                if payload is not None:
+                    headers['Content-Type'] = 'application/json'
+                start = time.perf_counter()
+                try:
+                    if conn is None:
+                        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                    conn.request(method, self.prefix + path, body=payload, headers=headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                    local_latencies.append(time.perf_counter() - start)
+                    if response.status not in expected:
+                        local_errors += 1
+                    elif callback is not None:
+                        callback(json.loads(data))
+                    if response.getheader('Connection', '').lower() == 'close':
+                        conn.close()
+                        conn = None
+                except (OSError, http.client.HTTPException):
+                    local_latencies.append(time.perf_counter() - start)
+                    local_errors += 1
+                    if conn is not None:
+                        conn.close()
+                    conn = None
+            if conn is not None:
+                conn.close()
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+        return {
+            'requests': requests,
+            'errors': sum(errors),
+            'duration': round(duration, 4),
+            'throughput': round(requests / duration, 2) if duration > 0 else None,
+            'latency_ms': summarize(latencies),
+        }
+
+
+def admin_token(secret_key):
+    payload = {
+        'username': 'admin',
+        'access': 'FULL',
+        'exp': datetime.now(tz=timezone.utc) + timedelta(hours=1)
+    }
+    return jwt.encode(payload, secret_key, algorithm='HS256')
+
+
+def run_http_scenarios(args, driver, size, token, fake_services):
+    results = []
+    # Fixed order so deregister always follows register
+    scenarios = [scenario for scenario in SCENARIOS if scenario in args.scenarios and scenario != 'health_sweep']
+    groups = max(1, size // INSTANCES_PER_SERVICE)
+    auth = {'Authorization': f'Bearer {token}'} if token else {}
+    registered = []
+    for concurrency in args.concurrency:
+        for scenario in scenarios:
+            if scenario == 'catalog':
+                make_request = lambda i: ('GET', '/services', None, None, (200,), None)
+            elif scenario == 'catalog_not_modified':
+                # Earlier write scenarios move the revision, so fetch it now
+                etag = driver.fetch('/services')[1].getheader('ETag')
+                make_request = lambda i: ('GET', '/services', None, {'If-None-Match': etag}, (304,), None)
+            elif scenario == 'filtered':
+                make_request = lambda i: ('GET', f'/services?name=svc-{i % groups}', None, None, (200,), None)
+            elif scenario == 'resolve':
+                make_request = lambda i: ('GET', f'/services/svc-{i % groups}/instances', None, None, (200,), None)
+            elif scenario == 'register':
+                run_id = secrets.token_hex(4)
+                make_request = lambda i: (
+                    'POST', '/services',
+                    {'name': 'bench-register', 'url': f'{fake_services.url(i) if fake_services else "http://bench.invalid/"}{run_id}/'},
+                    auth, (201,), lambda body: registered.append(body['UUID'])
+                )
+            elif scenario == 'deregister':
+                pending, registered = registered, []
+                make_request = lambda i: ('DELETE', '/services', {'id': pending[i]}, auth, (200,), None)
+            requests = args.write_requests if scenario == 'register' else args.requests
+            if scenario == 'deregister':
+                requests = len(pending)
+            if requests == 0:
+                continue
+            logger.info(f"{scenario}: {size} services, concurrency {concurrency}, {requests} requests")
+            result = {'scenario': scenario, 'services': size, 'concurrency': concurrency}
+            result.update(driver.run(concurrency, requests, make_request))
+            results.append(result)
+    return results
+
+
+def run_health_sweeps(args, storage, size):
+    targets = storage.fetch_probe_targets()
+    checker = HealthChecker(
+        concurrency=args.sweep_concurrency,
+        connect_timeout=args.probe_connect_timeout,
+        read_timeout=args.probe_read_timeout
+    )
+    durations = []
+    probe_latencies = []
+    failed = 0
+    for sweep in range(args.sweeps):
+        start = time.perf_counter()
+        sweep_results = checker.sweep(targets)
+        durations.append(time.perf_counter() - start)
+        # The first sweep opens every connection, later ones reuse them
+        probe_latencies.extend(result.latency for result in sweep_results)
+        failed = sum(1 for result in sweep_results if not result.ok)
+    total = sum(durations)
+    return {
+        'scenario': 'health_sweep',
+        'services': size,
+        'concurrency': args.sweep_concurrency,
+        'requests': len(targets) * args.sweeps,
+        'errors': failed,
+        'duration': round(total, 4),
+        'throughput': round(len(targets) * args.sweeps / total, 2) if total > 0 else None,
+        'latency_ms': summarize(durations),
+        'probe_latency_ms': summarize(probe_latencies),
+    }
+
+
+def result_key(result):
+    return f"{result['scenario']}/{result['services']}/{result['concurrency']}"
+
+
+def compare(results, baseline, tolerance):
+    # A result regresses when its p95 grows or its throughput drops by more
+    # than the tolerance, or when it fails more requests than the baseline
+    previous = {result_key(result): result for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        base = previous.get(result_key(result))
+        if base is None:
+            continue
+        checks = (
+            ('p95_ms', base['latency_ms']['p95'], result['latency_ms']['p95'],
+             lambda old, new: new > old * (1 + tolerance)),
+            ('throughput', base['throughput'], result['throughput'],
+             lambda old, new: new < old * (1 - tolerance)),
+            ('errors', base['errors'], result['errors'], lambda old, new: new > old),
+        )
+        for metric, old, new, worse in checks:
+            if old is not None and new is not None and worse(old, new):
+                regressions.append({'key': result_key(result), 'metric': metric, 'baseline': old, 'current': new})
+    return regressions
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def scenario_list(value):
+    scenarios = [item.strip() for item in value.split(',') if item.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown scenarios {unknown}, expected some of {list(SCENARIOS)}")
+    return scenarios
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Registry load test and benchmark harness')
+    parser.add_argument('--sizes', type=int_list, default=[100, 1000, 10000],
+                        help='catalog sizes to seed, comma separated (up to 100000)')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 16, 64],
+                        help='concurrent clients for the HTTP scenarios, comma separated')
+    parser.add_argument('--scenarios', type=scenario_list, default=list(SCENARIOS),
+                        help=f"comma separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument('--requests', type=int, default=2000, help='requests per read scenario run')
+    parser.add_argument('--write-requests', type=int, default=100,
+                        help='registrations per register run (each costs a bcrypt hash)')
+    parser.add_argument('--sweeps', type=int, default=3, help='health sweeps per catalog size')
+    parser.add_argument('--sweep-concurrency', type=int, default=256)
+    parser.add_argument('--probe-connect-timeout', type=float, default=1)
+    parser.add_argument('--probe-read-timeout', type=float, default=2)
+    parser.add_argument('--fail-ratio', type=float, default=0.0,
+                        help='fraction of fake services whose /health answers 503')
+    parser.add_argument('--fake-hosts', type=int, default=64,
+                        help='loopback addresses the fake services are spread over')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=64, help='gunicorn threads per worker')
+    parser.add_argument('--target', help='benchmark an already running registry or load balancer '
+                                         'instead of starting one (health_sweep is skipped)')
+    parser.add_argument('--token', help='bearer token for register/deregister with --target')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--save-baseline', help='also write the report to this baseline file')
+    parser.add_argument('--baseline', help='compare against this baseline and exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative change before a result counts as a regression')
+    return parser.parse_args(argv)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REGISTRY_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s %(message)s')
+    args = parse_args(argv)
+    results = []
+    if args.target:
+        driver = HttpDriver(args.target)
+        size = len(json.loads(driver.fetch('/services')[0]))
+        results.extend(run_http_scenarios(args, driver, size, args.token, None))
+    else:
+        secret_key = os.getenv('SECRET_KEY') or dotenv_values(os.path.join(REGISTRY_DIR, '.env')).get('SECRET_KEY')
+        token = admin_token(secret_key)
+        fake_services = FakeServices(args.fake_hosts)
+        fake_services.start()
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory(prefix='registry-bench-') as workdir:
+                db_path = os.path.join(workdir, 'registry.db')
+                storage = seed_catalog(db_path, size, fake_services, args.fail_ratio)
+                if 'health_sweep' in args.scenarios:
+                    results.append(run_health_sweeps(args, storage, size))
+                if any(scenario != 'health_sweep' for scenario in args.scenarios):
+                    server = RegistryServer(db_path, args.workers, args.threads, workdir)
+                    try:
+                        server.wait_ready()
+                        results.extend(run_http_scenarios(args, HttpDriver(server.base_url), size, token, fake_services))
+                    finally:
+                        server.stop()
+    report = {
+        'meta': {
+            'started_at': datetime.now(tz=timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'target': args.target,
+            'workers': args.workers,
+            'threads': args.threads,
+        },
+        'results': results,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(results, json.load(f), args.tolerance)
+        if report['regressions']:
+            exit_code = 1
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import os
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogSnapshot(object):
+    def __init__(self, revision, services, body):
+        self.revision = revision
+        self.services = services
+        self.body = body
+        self.etag = f"r{revision}"
+
+    def write(self, path):
+        # A one-line JSON header with the revision, then the serialized body.
+        # Written to a temp file and renamed so readers never see half a file
+        header = json.dumps({"revision": self.revision, "written_at": time.time()})
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header.encode("utf-8") + b"\n")
+            f.write(self.body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            body = f.read()
+        return cls(header["revision"], json.loads(body), body)
+
+    def open(self):
+        # A file object with the body for sendfile, None when it is only in
+        # memory
+        return None
+
+
+class CatalogCache(object):
+    # Serves the service catalog from memory. Local writes call invalidate();
+    # writes made by other workers/replicas are noticed by polling the cheap
+    # revision counter at most once every refresh_interval seconds.
+    # observe, if given, is called with the outcome of every get(): hit,
+    # revalidate (revision unchanged), load, stale (served after a failed
+    # refresh) or error.
+    # With shared (a SharedCatalog) the processes of one host share a single
+    # published catalog: whichever process refreshes first publishes it and
+    # the others switch to it on their next get().
+    def __init__(self, load, load_revision, serialize, refresh_interval, observe=None, shared=None):
+        self._load = load
+        self._load_revision = load_revision
+        self._serialize = serialize
+        self.refresh_interval = refresh_interval
+        self._observe = observe or (lambda outcome: None)
+        self._shared = shared
+        self._generation = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._retry_at = 0.0
+        self._stale = True
+        self._written_revision = None
+        self.degraded = False
+
+    @property
+    def revision(self):
+        snapshot = self._snapshot
+        return snapshot.revision if snapshot is not None else None
+
+    def invalidate(self):
+        self._stale = True
+        self._retry_at = 0.0
+        if self._shared is not None:
+            self._shared.expire()
+        self._notify()
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def _is_fresh(self):
+        return (
+            self._snapshot is not None
+            and not self._stale
+            and time.monotonic() - self._checked_at < self.refresh_interval
+        )
+
+    def _can_serve(self):
+        if self._is_fresh():
+            return True
+        # After a failed refresh keep serving the previous snapshot instead
+        # of retrying the database on every request.
+        return self._snapshot is not None and time.monotonic() < self._retry_at
+
+    def _is_current(self):
+        # Cheap check of the shared header on every lookup
+        if self._shared is None:
+            return True
+        header = self._shared.read_header()
+        if header is None:
+            return False
+        if header[0] != self._generation:
+            # Generation 0: nothing has been published yet
+            return header[0] == 0
+        self._checked_at = time.monotonic() - max(0.0, time.time() - header[2])
+        return True
+
+    def _adopt(self):
+        # Switches to the catalog published by another process. Only called
+        # with _lock held, so a thread can never swap an older one back in.
+        header = self._shared.read_header()
+        if header is None or header[0] == 0:
+            return
+        generation, revision, checked_at, _ = header
+        if generation != self._generation:
+            try:
+                snapshot = self._shared.snapshot(generation, revision)
+            except FileNotFoundError:
+                # Already replaced by a newer generation; the next get() retries
+                return
+            previous = self._snapshot
+            self._snapshot = snapshot
+            self._generation = generation
+            if previous is None or previous.revision != revision:
+                self._notify()
+        self._checked_at = time.monotonic() - max(0.0, time.time() - checked_at)
+
+    def get(self):
+        if self._is_current() and self._can_serve():
+            self._observe("hit")
+            return self._snapshot
+        with self._lock:
+            if self._shared is not None:
+                self._adopt()
+            if self._can_serve():
+                self._observe("hit")
+                return self._snapshot
+            try:
+                loaded = self._refresh()
+                self.degraded = False
+                self._observe("load" if loaded else "revalidate")
+            except Exception as e:
+                logger.error(f"Catalog refresh failed: {e}")
+                self.degraded = True
+                if self._snapshot is None:
+                    self._observe("error")
+                    raise
+                self._observe("stale")
+                self._retry_at = time.monotonic() + self.refresh_interval
+            return self._snapshot
+
+    def _refresh(self):
+        if self._shared is None:
+            return self._refresh_from_database()
+        with self._shared.lock():
+            # Another process may have refreshed while this one waited
+            self._adopt()
+            if self._is_fresh():
+                return False
+            return self._refresh_from_database()
+
+    def _refresh_from_database(self):
+        if self._snapshot is not None and not self._stale:
+            revision = self._load_revision()
+            if revision == self._snapshot.revision:
+                self._checked_at = time.monotonic()
+                if self._shared is not None:
+                    self._shared.touch(time.time())
+                return False
+        # Clear the flag before loading so an invalidate() that races with
+        # the load forces another refresh on the next request.
+        self._stale = False
+        try:
+            revision, services = self._load()
+        except Exception:
+            self._stale = True
+            raise
+        if self._shared is not None:
+            # Switch to the published copy so this process keeps no private one
+            self._shared.publish(revision, self._serialize(services), time.time())
+            self._adopt()
+            return True
+        previous = self._snapshot
+        self._snapshot = CatalogSnapshot(revision, services, self._serialize(services))
+        self._checked_at = time.monotonic()
+        if previous is None or previous.revision != revision:
+            self._notify()
+        return True
+
+    def load_file(self, path):
+        # Warm start: the file is only served until the database answers
+        # (it stays stale), or for as long as the database is unavailable
+        try:
+            snapshot = CatalogSnapshot.read(path)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error(f"Ignoring unreadable catalog snapshot {path}: {e}")
+            return False
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = snapshot
+                self._written_revision = snapshot.revision
+        logger.info(f"Loaded catalog snapshot revision {snapshot.revision} from {path}")
+        return True
+
+    def save_file(self, path):
+        # Called periodically; only rewrites the file when the revision moved
+        snapshot = self.get()
+        if snapshot.revision == self._written_revision or self.degraded:
+            return False
+        snapshot.write(path)
+        self._written_revision = snapshot.revision
+        return True
+
+    def wait(self, revision, timeout):
+        # Blocks until the catalog revision differs from the given one or the
+        # timeout passes. Waiters sleep on a condition and wake at most once
+        # per refresh_interval, and get() lets only one of them per interval
+        # reach the database, so idle watchers cost nothing per watcher.
+        deadline = time.monotonic() + timeout
+        snapshot = self.get()
+        while snapshot.revision == revision:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with self._changed:
+                self._changed.wait(min(remaining, self.refresh_interval))
+            snapshot = self.get()
+        return snapshot
@@ -0,0 +1,156 @@
+import os
+import queue
+import threading
+import time
+import logging
+
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(mysql.connector.Error):
+    pass
+
+
+class PooledConnection(object):
+    # Thin wrapper so existing call sites can keep calling conn.close();
+    # closing hands the connection back to the pool instead of the server.
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        self._pool.release(conn)
+
+
+class ConnectionPool(object):
+    def __init__(self, size, timeout, validate_after, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self._connect_args = connect_args
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections are per-process; a forked gunicorn worker must never
+        # reuse sockets inherited from its parent.
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._invalidated = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self._connect_args)
+        with self._lock:
+            self._created += 1
+        return conn
+
+    def _validate(self, conn, idle_since):
+        if time.monotonic() - idle_since < self.validate_after:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self._invalidated += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def get(self):
+        self._check_pid()
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._waits += 1
+            acquired = self._slots.acquire(timeout=self.timeout)
+            waited = time.monotonic() - start
+            with self._lock:
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+                if not acquired:
+                    self._timeouts += 1
+            if not acquired:
+                raise PoolTimeoutError(
+                    msg=f"Timed out after {self.timeout}s waiting for a database connection"
+                )
+        try:
+            conn = None
+            while conn is None:
+                try:
+                    candidate, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._connect()
+                    break
+                if self._validate(candidate, idle_since):
+                    conn = candidate
+                else:
+                    self._discard(candidate)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            # End any open transaction so the next borrower gets a fresh
+            # snapshot instead of one left over from a previous SELECT.
+            conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        except Exception:
+            self._discard(conn)
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "idle": self._idle.qsize(),
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time, 6),
+                "wait_time_max": round(self._max_wait_time, 6),
+                "timeouts": self._timeouts,
+                "invalidated": self._invalidated,
+            }
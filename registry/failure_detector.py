@@ -0,0 +1,82 @@
+import threading
+
+HEALTHY = "healthy"
+SUSPECT = "suspect"
+UNHEALTHY = "unhealthy"
+STATUSES = (HEALTHY, SUSPECT, UNHEALTHY)
+
+
+class ServiceHealth(object):
+    def __init__(self, status=HEALTHY):
+        self.status = status
+        self.failures = 0
+        self.successes = 0
+
+
+class FailureDetector(object):
+    # Consecutive-failure detector. A service is suspect after suspect_after
+    # failed probes, unhealthy after unhealthy_after and only evicted after
+    # evict_after; recover_after consecutive successes make it healthy again.
+    def __init__(self, suspect_after, unhealthy_after, evict_after, recover_after):
+        if not 1 <= suspect_after <= unhealthy_after <= evict_after:
+            raise ValueError("expected 1 <= suspect_after <= unhealthy_after <= evict_after")
+        self.suspect_after = suspect_after
+        self.unhealthy_after = unhealthy_after
+        self.evict_after = evict_after
+        self.recover_after = recover_after
+        self._lock = threading.Lock()
+        self._services = {}
+
+    def _state(self, service_id, known_status):
+        state = self._services.get(service_id)
+        if state is None:
+            # Seed from the persisted status so a new leader does not reset
+            # an unhealthy service back to a clean slate
+            state = ServiceHealth(known_status if known_status in STATUSES else HEALTHY)
+            if state.status == UNHEALTHY:
+                state.failures = self.unhealthy_after
+            elif state.status == SUSPECT:
+                state.failures = self.suspect_after
+            self._services[service_id] = state
+        return state
+
+    def observe(self, service_id, ok, known_status=None):
+        # Returns (new_status, evict)
+        with self._lock:
+            state = self._state(service_id, known_status)
+            if ok:
+                state.failures = 0
+                state.successes += 1
+                if state.status != HEALTHY and state.successes >= self.recover_after:
+                    state.status = HEALTHY
+                return state.status, False
+            state.successes = 0
+            state.failures += 1
+            if state.failures >= self.unhealthy_after:
+                state.status = UNHEALTHY
+            elif state.status == HEALTHY and state.failures >= self.suspect_after:
+                # A failure after a single success must not lift an
+                # unhealthy service back to suspect
+                state.status = SUSPECT
+            return state.status, state.failures >= self.evict_after
+
+    def status(self, service_id):
+        with self._lock:
+            state = self._services.get(service_id)
+            return state.status if state else None
+
+    def forget(self, service_id):
+        with self._lock:
+            self._services.pop(service_id, None)
+
+    def retain(self, service_ids):
+        with self._lock:
+            for service_id in set(self._services) - set(service_ids):
+                del self._services[service_id]
+
+    def summary(self):
+        with self._lock:
+            counts = dict.fromkeys(STATUSES, 0)
+            for state in self._services.values():
+                counts[state.status] += 1
+            return counts
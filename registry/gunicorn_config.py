@@ -1,13 +1,37 @@
 
 import logging
 import os
-from index import scheduler, app 
+from index import scheduler, app, leader_lock, metrics, profiler, WATCH_MAX_CONCURRENT
 
-workers = 4 
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+
+# Threaded workers so blocking watch queries on /services?index= park a
+# thread instead of a whole worker process. At most WATCH_MAX_CONCURRENT of
+# the threads (4/5 by default) hold a watch, further ones get a 429, so a
+# node serves up to GUNICORN_WORKERS * WATCH_MAX_CONCURRENT watchers: 800
+# with the defaults. A parked watch thread only waits on a condition, so
+# for thousands of watchers raise GUNICORN_THREADS (1000 threads cost about
+# 60MB per worker) together with WATCH_MAX_CONCURRENT.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '250'))
+if WATCH_MAX_CONCURRENT >= threads:
+    app.logger.warning(f"WATCH_MAX_CONCURRENT={WATCH_MAX_CONCURRENT} leaves none of the {threads} threads for other requests")
+# Longer than the load balancer's idle timeout, so it is always the balancer
+# that closes an idle pooled connection
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '75'))
 
 bind = '0.0.0.0:4152'
 
 loglevel = 'info'
 
+def on_starting(server):
+    # Counters from a previous run must not be merged into this one
+    metrics.clear()
+    profiler.clear()
+
 def post_fork(server, worker):
-    app.logger.info(f"Gunicorn Worker {worker.pid} has been forked and is ready.")
\ No newline at end of file
+    app.logger.info(f"Gunicorn Worker {worker.pid} has been forked and is ready.")
+
+def on_exit(server):
+    # Hand the health check leadership over immediately on shutdown
+    leader_lock.release()
\ No newline at end of file
@@ -0,0 +1,217 @@
+import asyncio
+import math
+import os
+import ssl
+import threading
+import time
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeResult(object):
+    def __init__(self, service_id, url, ok, latency, error=None):
+        self.service_id = service_id
+        self.url = url
+        self.ok = ok
+        self.latency = latency
+        self.error = error
+
+    def to_dict(self):
+        return {
+            "id": self.service_id,
+            "url": self.url,
+            "ok": self.ok,
+            "latency": round(self.latency, 6),
+            "error": self.error,
+        }
+
+
+class ProbeError(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    # Nearest rank of already sorted values
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class HealthChecker(object):
+    # Probes every service's /health endpoint from a dedicated asyncio loop.
+    # Concurrency is bounded by a semaphore, every probe has its own connect
+    # and read timeout, and connections are kept alive between sweeps so a
+    # steady-state sweep costs one request per service and no handshakes.
+    # stats() keeps aggregates and at most report_size failed and report_size
+    # slowest probes, so its size does not grow with the number of services.
+    def __init__(self, concurrency, connect_timeout, read_timeout, max_idle_per_host=2, report_size=20):
+        self.concurrency = concurrency
+        self.report_size = report_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._ssl_context = ssl.create_default_context()
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._last_sweep = None
+        self._loop = None
+        self._pid = None
+
+    def _ensure_loop(self):
+        # Started lazily (and restarted after a fork) because threads do not
+        # survive into forked gunicorn workers.
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._idle = {}
+                self._pid = os.getpid()
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="health-checker", daemon=True
+                ).start()
+            return self._loop
+
+    async def _open(self, scheme, host, port):
+        key = (scheme, host, port)
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host,
+                port,
+                ssl=self._ssl_context if scheme == "https" else None,
+                limit=2 ** 16,
+            ),
+            self.connect_timeout,
+        )
+        return reader, writer, False
+
+    def _keep(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.max_idle_per_host:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _read_body(self, reader, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    return True
+        if "content-length" in headers:
+            await reader.readexactly(int(headers["content-length"]))
+            return True
+        # No framing means the body runs until the server closes the socket
+        return False
+
+    async def _request(self, reader, writer, host_header, path):
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {host_header}\r\n"
+            "User-Agent: registry-health-check\r\nAccept: */*\r\n"
+            "Connection: keep-alive\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+            raise ProbeError(f"malformed status line {status_line!r}")
+        status = int(parts[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        reusable = await self._read_body(reader, headers)
+        if headers.get("connection", "").lower() == "close" or parts[0] == b"HTTP/1.0":
+            reusable = False
+        return status, reusable
+
+    async def _probe(self, semaphore, service):
+        service_id = service["id"]
+        service_url = service["url"]
+        async with semaphore:
+            start = time.monotonic()
+            writer = None
+            try:
+                target = urlsplit(f"{service_url}health")
+                scheme = target.scheme or "http"
+                port = target.port or (443 if scheme == "https" else 80)
+                key = (scheme, target.hostname, port)
+                path = target.path + (f"?{target.query}" if target.query else "")
+                host_header = target.netloc.rpartition("@")[2]
+                reader, writer, reused = await self._open(*key)
+                try:
+                    status, reusable = await asyncio.wait_for(
+                        self._request(reader, writer, host_header, path),
+                        self.read_timeout,
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server dropped an idle keep-alive connection; retry
+                    # once on a fresh one before calling the service dead.
+                    writer.close()
+                    reader, writer, _ = await self._open(*key)
+                    status, reusable = await asyncio.wait_for(
+                        self._request(reader, writer, host_header, path),
+                        self.read_timeout,
+                    )
+                if reusable:
+                    self._keep(key, reader, writer)
+                else:
+                    writer.close()
+                writer = None
+                if status >= 400:
+                    raise ProbeError(f"HTTP {status}")
+                return ProbeResult(service_id, service_url, True, time.monotonic() - start)
+            except Exception as e:
+                if writer is not None:
+                    writer.close()
+                error = str(e) or type(e).__name__
+                return ProbeResult(
+                    service_id, service_url, False, time.monotonic() - start, error
+                )
+
+    async def _sweep(self, services):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*(self._probe(semaphore, service) for service in services))
+
+    def sweep(self, services):
+        start = time.monotonic()
+        loop = self._ensure_loop()
+        results = asyncio.run_coroutine_threadsafe(self._sweep(services), loop).result()
+        duration = time.monotonic() - start
+        failures = [result for result in results if not result.ok]
+        failed = len(failures)
+        by_latency = sorted(results, key=lambda result: result.latency, reverse=True)
+        latencies = [result.latency for result in reversed(by_latency)]
+        with self._lock:
+            self._last_sweep = {
+                "finished_at": time.time(),
+                "duration": round(duration, 6),
+                "probed": len(results),
+                "failed": failed,
+                "concurrency": self.concurrency,
+                "latency_p50": round(percentile(latencies, 0.5), 6),
+                "latency_p99": round(percentile(latencies, 0.99), 6),
+                "latency_max": round(latencies[-1], 6) if latencies else 0.0,
+                "failed_probes": [result.to_dict() for result in failures[:self.report_size]],
+                "slowest_probes": [result.to_dict() for result in by_latency[:self.report_size]],
+            }
+        logger.info(
+            f"health sweep probed {len(results)} services in {duration:.3f}s, {failed} failed"
+        )
+        return results
+
+    def stats(self):
+        with self._lock:
+            return self._last_sweep or {}
@@ -1,17 +1,31 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, g, jsonify, request, send_from_directory
+from werkzeug.wsgi import wrap_file
 import mysql.connector
+import sqlite3
 import uuid
 import jwt
 import bcrypt
 from datetime import datetime, timezone, timedelta
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import secrets
 import os
+import time
+import base64
+from urllib.parse import urlencode
 from flask_apscheduler import APScheduler
 import logging
 import sys
-import requests
+import threading
+from storage import create_storage
+from catalog_cache import CatalogCache
+from shared_catalog import SharedCatalog
+from health_checker import HealthChecker
+from leader import MySQLLeaderLock, FileLeaderLock
+from failure_detector import FailureDetector
+from metrics import MetricsRegistry, instrument_app
+from profiling import Profiler, install_profiler
 
 load_dotenv()
 SECRET_KEY = os.getenv('SECRET_KEY')
@@ -20,6 +34,66 @@ DB_USER=os.getenv('DB_USER')
 DB_PW=os.getenv('DB_PW')
 DB_NAME=os.getenv('DB_NAME')
 DB_HOST=os.getenv('DB_HOST')
+STORAGE_BACKEND=os.getenv('STORAGE_BACKEND', 'mysql')
+SQLITE_PATH=os.getenv('SQLITE_PATH', 'registry.db')
+SQLITE_BUSY_TIMEOUT=float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+DB_POOL_SIZE=int(os.getenv('DB_POOL_SIZE', '5'))
+DB_POOL_TIMEOUT=float(os.getenv('DB_POOL_TIMEOUT', '5'))
+DB_POOL_VALIDATE_AFTER=float(os.getenv('DB_POOL_VALIDATE_AFTER', '30'))
+TOKEN_TTL=int(os.getenv('TOKEN_TTL', '120'))
+SERVICE_TOKEN_TTL=int(os.getenv('SERVICE_TOKEN_TTL', '86400'))
+SESSION_MAX_AGE=int(os.getenv('SESSION_MAX_AGE', '28800'))
+SERVICE_SESSION_MAX_AGE=int(os.getenv('SERVICE_SESSION_MAX_AGE', '604800'))
+INSTANCE_DEFAULT_WEIGHT=int(os.getenv('INSTANCE_DEFAULT_WEIGHT', '100'))
+INSTANCE_MAX_WEIGHT=int(os.getenv('INSTANCE_MAX_WEIGHT', '1000'))
+INSTANCE_MAX_TAGS=int(os.getenv('INSTANCE_MAX_TAGS', '32'))
+BATCH_MAX_ITEMS=int(os.getenv('BATCH_MAX_ITEMS', '500'))
+BCRYPT_WORKERS=int(os.getenv('BCRYPT_WORKERS', str(os.cpu_count() or 1)))
+CATALOG_REFRESH_INTERVAL=float(os.getenv('CATALOG_REFRESH_INTERVAL', '1'))
+CATALOG_SNAPSHOT_PATH=os.getenv('CATALOG_SNAPSHOT_PATH', '/tmp/registry_catalog.snapshot')
+CATALOG_SNAPSHOT_INTERVAL=int(os.getenv('CATALOG_SNAPSHOT_INTERVAL', '30'))
+# tmpfs directory where the workers share one serialized catalog, empty to
+# give every worker its own copy
+CATALOG_SHARED_DIR=os.getenv('CATALOG_SHARED_DIR', '/dev/shm/registry_catalog')
+HEALTH_CHECK_INTERVAL=int(os.getenv('HEALTH_CHECK_INTERVAL', '5'))
+HEALTH_CHECK_CONCURRENCY=int(os.getenv('HEALTH_CHECK_CONCURRENCY', '256'))
+HEALTH_CHECK_CONNECT_TIMEOUT=float(os.getenv('HEALTH_CHECK_CONNECT_TIMEOUT', '1'))
+HEALTH_CHECK_READ_TIMEOUT=float(os.getenv('HEALTH_CHECK_READ_TIMEOUT', '2'))
+# Failed and slowest probes each listed by GET /stats/health
+HEALTH_STATS_PROBES=int(os.getenv('HEALTH_STATS_PROBES', '20'))
+# An embedded database means a single host, where a lock file is enough
+LEADER_ELECTION=os.getenv('LEADER_ELECTION', 'file' if STORAGE_BACKEND == 'sqlite' else 'mysql')
+LEADER_LOCK_NAME=os.getenv('LEADER_LOCK_NAME', 'registry_health_check')
+LEADER_LOCK_FILE=os.getenv('LEADER_LOCK_FILE', '/tmp/registry_health_check.lock')
+# Where the leader publishes its sweep statistics for GET /stats/health
+HEALTH_STATS_PATH=os.getenv('HEALTH_STATS_PATH', '/tmp/registry_health_stats.json')
+HEALTH_SUSPECT_AFTER=int(os.getenv('HEALTH_SUSPECT_AFTER', '1'))
+HEALTH_UNHEALTHY_AFTER=int(os.getenv('HEALTH_UNHEALTHY_AFTER', '3'))
+HEALTH_EVICT_AFTER=int(os.getenv('HEALTH_EVICT_AFTER', '6'))
+HEALTH_RECOVER_AFTER=int(os.getenv('HEALTH_RECOVER_AFTER', '2'))
+SERVICES_PAGE_MAX=int(os.getenv('SERVICES_PAGE_MAX', '1000'))
+WATCH_DEFAULT_WAIT=float(os.getenv('WATCH_DEFAULT_WAIT', '30'))
+WATCH_MAX_WAIT=float(os.getenv('WATCH_MAX_WAIT', '300'))
+# Blocking queries a worker holds at once, kept below GUNICORN_THREADS so
+# parked watches always leave threads for the other requests; 4/5 of the
+# threads unless set
+WATCH_MAX_CONCURRENT=int(os.getenv('WATCH_MAX_CONCURRENT', str(max(1, int(os.getenv('GUNICORN_THREADS', '250')) * 4 // 5))))
+WATCH_RETRY_AFTER=int(os.getenv('WATCH_RETRY_AFTER', '1'))
+CHANGE_LOG_RETENTION=int(os.getenv('CHANGE_LOG_RETENTION', '10000'))
+CHANGE_LOG_COMPACT_INTERVAL=int(os.getenv('CHANGE_LOG_COMPACT_INTERVAL', '60'))
+CHANGES_PAGE_MAX=int(os.getenv('CHANGES_PAGE_MAX', '500'))
+USER_COMPACT_INTERVAL=int(os.getenv('USER_COMPACT_INTERVAL', '300'))
+LEASE_SWEEP_INTERVAL=int(os.getenv('LEASE_SWEEP_INTERVAL', '5'))
+LEASE_MAX_TTL=int(os.getenv('LEASE_MAX_TTL', '300'))
+METRICS_DIR=os.getenv('METRICS_DIR', '/tmp/registry_metrics')
+METRICS_FLUSH_INTERVAL=float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+# Profiling is off unless a sample rate, slow threshold or debug token is set
+PROFILE_SAMPLE_RATE=float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_THRESHOLD=float(os.getenv('PROFILE_SLOW_THRESHOLD', '0'))
+PROFILE_TOKEN=os.getenv('PROFILE_TOKEN')
+PROFILE_INTERVAL=float(os.getenv('PROFILE_INTERVAL', '0.005'))
+PROFILE_BUFFER_SIZE=int(os.getenv('PROFILE_BUFFER_SIZE', '100'))
+PROFILE_DIR=os.getenv('PROFILE_DIR', '/tmp/registry_profiles')
 
 class Config(object):
     SCHEDULER_API_ENABLED = True
@@ -37,26 +111,197 @@ if not root_logger.handlers:
 logger = logging.getLogger(__name__)
 logger.info("testing logger 111")
 
+# Shared by all gunicorn workers through METRICS_DIR, served on GET /metrics
+metrics = MetricsRegistry(directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL)
+instrument_app(app, metrics)
+db_query_seconds = metrics.histogram(
+    'registry_db_query_duration_seconds',
+    'Storage transaction time including connection checkout',
+    ['operation']
+)
+catalog_lookups = metrics.counter(
+    'registry_catalog_lookups_total',
+    'Catalog cache lookups by outcome (hit, revalidate, load, stale, error)',
+    ['outcome']
+)
+health_sweep_seconds = metrics.histogram(
+    'registry_health_sweep_duration_seconds',
+    'Duration of a full health sweep',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+health_probe_seconds = metrics.histogram(
+    'registry_health_probe_duration_seconds',
+    'Latency of a single health probe'
+)
+health_probes = metrics.counter('registry_health_probes_total', 'Health probes by result', ['result'])
+health_evictions = metrics.counter('registry_health_evictions_total', 'Services evicted by the health checker')
+watches_rejected = metrics.counter('registry_watch_rejected_total', 'Blocking queries refused because every watch slot was taken')
+metrics.gauge(
+    'registry_storage',
+    'Storage backend and connection pool statistics',
+    read=lambda: {(key,): value for key, value in storage.stats().items() if isinstance(value, (int, float))},
+    labels=['stat']
+)
+metrics.gauge(
+    'registry_catalog_revision',
+    'Catalog revision served from the cache',
+    read=lambda: catalog.revision,
+    aggregate='max'
+)
+
+# Captured profiles are downloaded from GET /admin/profiles
+profiler = Profiler(
+    sample_rate=PROFILE_SAMPLE_RATE,
+    slow_threshold=PROFILE_SLOW_THRESHOLD,
+    token=PROFILE_TOKEN,
+    interval=PROFILE_INTERVAL,
+    buffer_size=PROFILE_BUFFER_SIZE,
+    directory=PROFILE_DIR
+)
 
 
+
+health_checker = HealthChecker(
+    concurrency=HEALTH_CHECK_CONCURRENCY,
+    connect_timeout=HEALTH_CHECK_CONNECT_TIMEOUT,
+    read_timeout=HEALTH_CHECK_READ_TIMEOUT,
+    report_size=HEALTH_STATS_PROBES
+)
+
+failure_detector = FailureDetector(
+    suspect_after=HEALTH_SUSPECT_AFTER,
+    unhealthy_after=HEALTH_UNHEALTHY_AFTER,
+    evict_after=HEALTH_EVICT_AFTER,
+    recover_after=HEALTH_RECOVER_AFTER
+)
+
+# A MySQL lock with SQLite storage would never be acquired, so no leader
+# would ever run the health checks, lease expiry or compaction
+if LEADER_ELECTION not in ('file', 'mysql') or (LEADER_ELECTION == 'mysql' and STORAGE_BACKEND == 'sqlite'):
+    logger.error(f"LEADER_ELECTION={LEADER_ELECTION} does not work with STORAGE_BACKEND={STORAGE_BACKEND}; "
+                 f"use file or mysql, and mysql only with MySQL storage")
+    sys.exit(1)
+if LEADER_ELECTION == 'file':
+    leader_lock = FileLeaderLock(LEADER_LOCK_FILE)
+else:
+    leader_lock = MySQLLeaderLock(
+        LEADER_LOCK_NAME,
+        connect=lambda: mysql.connector.connect(
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PW,
+            database=DB_NAME,
+            port = 3306
+        )
+    )
+
 def health_check():
-    services = fetch_services_from_database()
+    # Every process running the scheduler tries (under gunicorn that is the
+    # master of each replica, the workers never run jobs), but only the
+    # elected leader sweeps
+    if not leader_lock.is_leader():
+        return
+    try:
+        services = storage.fetch_probe_targets()
+    except Exception as e:
+        logger.error(f"Error executing scheduled database fetch: {e}")
+        return
     logger.info(f"found {len(services)} services")
-    for service in services:
-        service_id = service["id"]
-        service_url = service["url"]
-        logger.info(f"preforming health check for service id: {service_id} url: {service_url}")
-        try:
-            response =  requests.get(
-                url=f"{service_url}health"
-            )
-            response.raise_for_status()
-            logger.info(f"health check response: {response}")
-        except Exception as e:
-            logger.info(f"health check failed {e} removing from registry...")
-            success = remove_service_from_database(service_id)
-            logger.info(f"Success? {success}")
-            
+    known_status = {service["id"]: service["status"] for service in services}
+    failure_detector.retain(known_status)
+    status_changes = {}
+    evictions = []
+    start = time.perf_counter()
+    results = health_checker.sweep(services)
+    health_sweep_seconds.observe(time.perf_counter() - start)
+    for result in results:
+        health_probe_seconds.observe(result.latency)
+        health_probes.inc('ok' if result.ok else 'failed')
+        status, evict = failure_detector.observe(
+            result.service_id, result.ok, known_status[result.service_id]
+        )
+        if evict:
+            logger.info(f"health check failed for service id: {result.service_id} url: {result.url} ({result.error}) removing from registry...")
+            evictions.append(result.service_id)
+        elif status != known_status[result.service_id]:
+            logger.info(f"service id: {result.service_id} is now {status} ({result.error})")
+            status_changes.setdefault(status, []).append(result.service_id)
+    if status_changes:
+        update_service_statuses(status_changes)
+    if evictions:
+        evict_services(evictions)
+    publish_health_stats()
+
+def local_health_stats():
+    stats = dict(health_checker.stats())
+    stats["status_counts"] = failure_detector.summary()
+    stats["last_eviction"] = eviction_stats
+    stats["leader_pid"] = os.getpid() if leader_lock.held() else None
+    return stats
+
+def publish_health_stats():
+    # The sweep state lives in the process that ran it, which is not the
+    # worker answering /stats/health, so it is written to a file every
+    # worker on this host can read
+    if not HEALTH_STATS_PATH:
+        return
+    stats = dict(local_health_stats(), published_at=time.time())
+    tmp_path = f"{HEALTH_STATS_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(app.json.dumps(stats))
+        os.replace(tmp_path, HEALTH_STATS_PATH)
+    except OSError as e:
+        logger.warning(f"Failed to publish health stats: {e}")
+
+def evict_services(service_ids):
+    # All verdicts of a sweep are applied as one set-based transaction
+    start = time.monotonic()
+    try:
+        removed = remove_services_from_database(service_ids, reason='evict')
+    except Exception as e:
+        logger.error(f"Failed to evict {len(service_ids)} services: {e}")
+        return
+    write_seconds = time.monotonic() - start
+    for service_id in service_ids:
+        failure_detector.forget(service_id)
+    health_evictions.inc(amount=len(removed))
+    eviction_stats.update({
+        "batch_size": len(service_ids),
+        "removed": len(removed),
+        "write_seconds": round(write_seconds, 6),
+        "finished_at": time.time()
+    })
+    logger.info(f"evicted {len(removed)} of {len(service_ids)} services in {write_seconds:.3f}s")
+
+eviction_stats = {}
+
+def compact_orphaned_users():
+    if not leader_lock.is_leader():
+        return
+    removed = storage.compact_orphaned_users()
+    if removed > 0:
+        logger.info(f"removed {removed} orphaned service credentials")
+
+def update_service_statuses(status_changes):
+    # Only transitions are written, so a steady fleet costs no writes
+    storage.update_statuses(status_changes)
+    catalog.invalidate()
+
+def expire_leased_services():
+    if not leader_lock.is_leader():
+        return
+    expired_ids = storage.expire_leases()
+    if expired_ids:
+        catalog.invalidate()
+        logger.info(f"expired {len(expired_ids)} leased services")
+
+def compact_change_log():
+    if not leader_lock.is_leader():
+        return
+    removed, compacted = storage.compact_change_log(CHANGE_LOG_RETENTION)
+    if removed > 0:
+        logger.info(f"compacted {removed} change log entries up to revision {compacted}")
 
 
 scheduler = APScheduler()
@@ -66,22 +311,66 @@ scheduler.add_job(
     id='health_check_job', 
     func=health_check, 
     trigger='interval', 
-    seconds=5
+    seconds=HEALTH_CHECK_INTERVAL
 )
-def get_reg_db_conn():
-    try:
-        mydb = mysql.connector.connect(
+scheduler.add_job(
+    id='lease_expiry_job', 
+    func=expire_leased_services, 
+    trigger='interval', 
+    seconds=LEASE_SWEEP_INTERVAL
+)
+scheduler.add_job(
+    id='change_log_compaction_job', 
+    func=compact_change_log, 
+    trigger='interval', 
+    seconds=CHANGE_LOG_COMPACT_INTERVAL
+)
+scheduler.add_job(
+    id='user_compaction_job', 
+    func=compact_orphaned_users, 
+    trigger='interval', 
+    seconds=USER_COMPACT_INTERVAL
+)
+if STORAGE_BACKEND == 'sqlite':
+    storage = create_storage('sqlite', path=SQLITE_PATH, busy_timeout=SQLITE_BUSY_TIMEOUT)
+else:
+    storage = create_storage(
+        'mysql',
+        pool_size=DB_POOL_SIZE,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_validate_after=DB_POOL_VALIDATE_AFTER,
         host=DB_HOST,
         user=DB_USER,
         password=DB_PW,
         database=DB_NAME,
         port = 3306
-        )
-        return mydb
-    except mysql.connector.Error as err:
-        logger.error(f"Database connection error: {err}")
-        raise
+    )
+def observe_query(operation, seconds):
+    db_query_seconds.observe(seconds, operation)
+    profiler.record(f'db.{operation}', seconds)
+
+storage.observe = observe_query
+
 
+def session_max_age(access):
+    return SERVICE_SESSION_MAX_AGE if access == 'SELF' else SESSION_MAX_AGE
+
+def issue_token(username, access, auth_time=None):
+    # Services get long-lived SELF tokens so heartbeats and deregistration
+    # never need a bcrypt login. auth_time is when the session started and
+    # is carried through refreshes, no token outlives the session
+    ttl = SERVICE_TOKEN_TTL if access == 'SELF' else TOKEN_TTL
+    now = datetime.now(tz=timezone.utc)
+    if auth_time is None:
+        auth_time = int(now.timestamp())
+    expires = min(now+timedelta(seconds=ttl), datetime.fromtimestamp(auth_time+session_max_age(access), tz=timezone.utc))
+    payload = {
+        "username": username,
+        "access": access,
+        "auth_time": auth_time,
+        "exp": expires
+    }
+    return jwt.encode(payload, app.config['SECRET KEY'], algorithm='HS256')
 
 # POST Endpoint for auth
 @app.route('/login', methods=['POST'])
@@ -94,27 +383,16 @@ def login():
         return jsonify({'message': f'Missing Credentials'}), 400
     
     # Check if credentials match 
-    sql = """
-    SELECT * FROM users WHERE username = %s;
-    """
-    conn = get_reg_db_conn()
-    cursor = conn.cursor()
-    params =[]
-    params.append(username)
-    cursor.execute(sql, params)
-    user = cursor.fetchall()
-    username_db,password_db,access_db = user[0]
-    cursor.close()
-    conn.close()
-    if user and bcrypt.checkpw(password.encode('utf-8'), password_db.encode('utf-8')):
-        payload = {
-            "username": username_db,
-            "access": access_db,
-            "exp": datetime.now(tz=timezone.utc)+timedelta(minutes=2)
-        }
-        token = jwt.encode(payload, app.config['SECRET KEY'], algorithm='HS256')
+    user = storage.get_user(username)
+    if user:
+        username_db,password_db,access_db = user['username'],user['password_hash'],user['write_access']
+    with profiler.span('bcrypt'):
+        valid = user and bcrypt.checkpw(password.encode('utf-8'), password_db.encode('utf-8'))
+    if valid:
+        token = issue_token(username_db, access_db)
         return jsonify({'token': token}), 200
-    password = bcrypt.hashpw((password).encode('utf-8'), PW_SALT,)
+    with profiler.span('bcrypt'):
+        password = bcrypt.hashpw((password).encode('utf-8'), PW_SALT,)
     return jsonify({'message': f'Invalid Credentials {username}, {password}'}), 401
 
 # Decorator for POST/DELETE services
@@ -150,33 +428,305 @@ def auth_required(f):
             print(f"JWT Decode Error: {e}")
             return jsonify({'message': 'Invalid token'}), 401
         
+        g.token_claims = data
         return f(username, access,*args,**kwargs)
     return decorated
+
+# Decorator for admin only endpoints
+def admin_required(f):
+    @wraps(f)
+    @auth_required
+    def decorated(user, access, *args, **kwargs):
+        if access != 'FULL':
+            return jsonify({'message': 'Admin access required'}), 403
+        return f(*args, **kwargs)
+    return decorated
+
+install_profiler(app, profiler, admin_required)
+
+# POST Endpoint for token renewal, a still-valid token buys a fresh one
+# without another bcrypt check, until the session is SESSION_MAX_AGE old
+# (SERVICE_SESSION_MAX_AGE for services) and a login is needed again
+@app.route('/login/refresh', methods=['POST'])
+@auth_required
+def refresh_token(user=None, access=None):
+    auth_time = g.token_claims.get('auth_time')
+    if not isinstance(auth_time, int) or time.time() - auth_time >= session_max_age(access):
+        return jsonify({'message': 'Session expired, log in again'}), 401
+    # The user may have been removed (a deregistered service) or had its
+    # access changed since the token was issued
+    stored = storage.get_user(user)
+    if not stored:
+        return jsonify({'message': 'Unknown user'}), 401
+    return jsonify({'token': issue_token(user, stored['write_access'], auth_time)}), 200
         
 
 
-def fetch_services_from_database():
-    sql = "SELECT * FROM services;"
-    conn = None
-    cursor = None
+# Rows of the services table are service instances; instances of one logical
+# service share a name
+SERVICE_FIELDS = ('id', 'name', 'description', 'url', 'status', 'weight', 'zone', 'version', 'tags')
+SERVICE_QUERY_ARGS = ('name', 'prefix', 'status', 'fields', 'limit', 'cursor')
+
+def encode_cursor(service_id):
+    return base64.urlsafe_b64encode(service_id.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+
+def query_services_from_database(name=None, prefix=None, statuses=None, fields=SERVICE_FIELDS, after=None, limit=None):
+    rows, next_after = storage.query_services(
+        [field for field in fields if field != 'tags'],
+        name=name,
+        prefix=prefix,
+        statuses=statuses,
+        after=after,
+        limit=limit,
+        tags='tags' in fields
+    )
+    if 'id' not in fields:
+        for row in rows:
+            del row['id']
+    return rows, (encode_cursor(next_after) if next_after else None)
+
+shared_catalog = SharedCatalog(CATALOG_SHARED_DIR) if CATALOG_SHARED_DIR else None
+catalog = CatalogCache(
+    load=storage.fetch_catalog,
+    load_revision=storage.fetch_catalog_revision,
+    serialize=lambda services: app.json.dumps(services, separators=(',', ':')).encode('utf-8'),
+    refresh_interval=CATALOG_REFRESH_INTERVAL,
+    observe=lambda outcome: catalog_lookups.inc(outcome),
+    shared=shared_catalog
+)
+catalog.load_file(CATALOG_SNAPSHOT_PATH)
+
+def save_catalog_snapshot():
     try:
-        conn = get_reg_db_conn()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(sql)
-        reg_services = cursor.fetchall()
-        return reg_services
+        if catalog.save_file(CATALOG_SNAPSHOT_PATH):
+            logger.info(f"wrote catalog snapshot to {CATALOG_SNAPSHOT_PATH}")
     except Exception as e:
-        logger.error(f"Error executing scheduled database fetch: {e}")
-        return []
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        logger.error(f"Failed to write catalog snapshot: {e}")
+
+scheduler.add_job(
+    id='catalog_snapshot_job', 
+    func=save_catalog_snapshot, 
+    trigger='interval', 
+    seconds=CATALOG_SNAPSHOT_INTERVAL
+)
+
+def parse_wait(value):
+    # Accepts Consul style durations such as 500ms, 30s or 5m
+    units = (('ms', 0.001), ('s', 1), ('m', 60))
+    for suffix, scale in units:
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * scale
+    return float(value)
+
+# Each blocking query parks a gthread thread for up to its wait, so they get
+# their own bounded share of the worker's threads
+watch_slots = threading.BoundedSemaphore(WATCH_MAX_CONCURRENT)
+
+def watch_slots_full():
+    watches_rejected.inc()
+    response = jsonify({'message': 'Too many blocking queries, retry later'})
+    response.headers['Retry-After'] = str(WATCH_RETRY_AFTER)
+    return response, 429
+
+def get_filtered_services():
+    args = request.args
+    fields = SERVICE_FIELDS
+    if args.get('fields'):
+        fields = tuple(field.strip() for field in args['fields'].split(',') if field.strip())
+        unknown = [field for field in fields if field not in SERVICE_FIELDS]
+        if unknown or not fields:
+            return jsonify({'message': f'Unknown fields: {unknown}. Allowed: {list(SERVICE_FIELDS)}'}), 400
+    statuses = None
+    if args.get('status'):
+        statuses = [status.strip() for status in args['status'].split(',') if status.strip()]
+    limit = None
+    if args.get('limit'):
+        try:
+            limit = int(args['limit'])
+        except ValueError:
+            return jsonify({'message': 'limit must be an integer'}), 400
+        if limit < 1 or limit > SERVICES_PAGE_MAX:
+            return jsonify({'message': f'limit must be between 1 and {SERVICES_PAGE_MAX}'}), 400
+    elif args.get('cursor'):
+        limit = SERVICES_PAGE_MAX
+    after = None
+    if args.get('cursor'):
+        try:
+            after = decode_cursor(args['cursor'])
+        except Exception:
+            return jsonify({'message': 'Invalid cursor'}), 400
+    try:
+        rows, next_cursor = query_services_from_database(
+            name=args.get('name'),
+            prefix=args.get('prefix'),
+            statuses=statuses,
+            fields=fields,
+            after=after,
+            limit=limit
+        )
+    except Exception as e:
+        logger.error(f"Error executing filtered service query: {e}")
+        return jsonify({'message': 'Service query failed'}), 503
+    response = jsonify(rows)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        next_args = args.to_dict()
+        next_args['cursor'] = next_cursor
+        if limit is not None:
+            next_args['limit'] = str(limit)
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(next_args)}>; rel="next"'
+    return response, 200
 
 # GET Endpoint
+# With ?index=<revision> this is a blocking query: it returns once the catalog
+# revision moves past <revision>, or after ?wait= (default WATCH_DEFAULT_WAIT)
 @app.route('/services')
 def get_services(user=None, access=None):
-    reg_services = fetch_services_from_database()
-    return jsonify(reg_services), 200
+    snapshot = None
+    if 'index' in request.args:
+        try:
+            index = int(request.args['index'])
+            wait = parse_wait(request.args.get('wait', str(WATCH_DEFAULT_WAIT)))
+        except ValueError:
+            return jsonify({'message': 'index must be an integer and wait a duration like 30s'}), 400
+        if not watch_slots.acquire(blocking=False):
+            return watch_slots_full()
+        try:
+            snapshot = catalog.wait(index, max(0.0, min(wait, WATCH_MAX_WAIT)))
+        except Exception as e:
+            logger.error(f"Error loading service catalog: {e}")
+            return jsonify({'message': 'Service catalog unavailable'}), 503
+        finally:
+            watch_slots.release()
+    if any(arg in request.args for arg in SERVICE_QUERY_ARGS):
+        response, status = get_filtered_services()
+        if snapshot is not None:
+            response.headers['X-Catalog-Revision'] = str(snapshot.revision)
+        return response, status
+    try:
+        if snapshot is None:
+            snapshot = catalog.get()
+    except Exception as e:
+        # No database and no snapshot: an empty list would tell clients that
+        # every service is gone
+        logger.error(f"Error loading service catalog: {e}")
+        return jsonify({'message': 'Service catalog unavailable'}), 503
+    response = app.response_class(status=200, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.headers['X-Catalog-Revision'] = str(snapshot.revision)
+    if catalog.degraded:
+        response.headers['X-Registry-Degraded'] = 'true'
+    response.cache_control.no_cache = True
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+    body = snapshot.open()
+    if body is None:
+        # A shared body is a mmap, which a WSGI server cannot write out
+        response.set_data(bytes(snapshot.body))
+    else:
+        # Shared catalog: gunicorn sends the file with sendfile, no copy
+        response.response = wrap_file(request.environ, body)
+        response.direct_passthrough = True
+        response.content_length = len(snapshot.body)
+    return response
+
+# bcrypt releases the GIL, so batch credential hashing runs in parallel here
+hash_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
+def hash_password(password):
+    # Stored as text: SQLite would keep bytes as a BLOB and hand them back
+    # as bytes, where MySQL returns a string
+    with profiler.span('bcrypt'):
+        return bcrypt.hashpw((password).encode('utf-8'), PW_SALT,).decode('utf-8')
+
+def parse_service_registration(new_service):
+    # Returns (registration, error message)
+    if not isinstance(new_service, dict):
+        return None, 'Expected a JSON object'
+    ttl = new_service.get('ttl')
+    if ttl is not None:
+        try:
+            ttl = int(ttl)
+        except (TypeError, ValueError):
+            return None, 'ttl must be an integer number of seconds'
+        if ttl < 1 or ttl > LEASE_MAX_TTL:
+            return None, f'ttl must be between 1 and {LEASE_MAX_TTL} seconds'
+    if not new_service.get('name') or not new_service.get('url'):
+        return None, 'name and url are required'
+    # The column sizes of the services table
+    for label, value, max_length in (('name', new_service['name'], 255), ('url', new_service['url'], 2048)):
+        if not isinstance(value, str) or not value.strip() or len(value) > max_length:
+            return None, f'{label} must be a non-empty string of at most {max_length} characters'
+    weight = new_service.get('weight', INSTANCE_DEFAULT_WEIGHT)
+    try:
+        weight = int(weight)
+    except (TypeError, ValueError):
+        return None, 'weight must be an integer'
+    if weight < 0 or weight > INSTANCE_MAX_WEIGHT:
+        return None, f'weight must be between 0 and {INSTANCE_MAX_WEIGHT}'
+    zone = new_service.get('zone')
+    version = new_service.get('version')
+    for label, value in (('zone', zone), ('version', version)):
+        if value is not None and (not isinstance(value, str) or len(value) > 64):
+            return None, f'{label} must be a string of at most 64 characters'
+    tags = new_service.get('tags') or []
+    if (
+        not isinstance(tags, list)
+        or len(tags) > INSTANCE_MAX_TAGS
+        or not all(isinstance(tag, str) and 0 < len(tag) <= 64 for tag in tags)
+    ):
+        return None, f'tags must be a list of at most {INSTANCE_MAX_TAGS} strings of 1 to 64 characters'
+    return {
+        'id': str(uuid.uuid4()),
+        'name': new_service.get('name'),
+        'description': new_service.get('description'),
+        'url': new_service.get('url'),
+        'ttl': ttl,
+        'weight': weight,
+        'zone': zone,
+        'version': version,
+        'tags': sorted(set(tags)),
+        'password': secrets.token_urlsafe(32)
+    }, None
+
+def insert_services_into_database(registrations, password_hashes):
+    storage.register_services(registrations, password_hashes)
+    catalog.invalidate()
+
+def registration_response(registration):
+    response = {
+        "UUID": registration['id'],
+        "password": registration['password'],
+        "token": issue_token(registration['id'], 'SELF')
+    }
+    if registration['ttl'] is not None:
+        response['ttl'] = registration['ttl']
+    return response
+
+# GET Resolve Endpoint
+# Healthy instances of one logical service, for client-side balancing
+@app.route('/services/<name>/instances')
+def resolve_service(name):
+    try:
+        instances = storage.resolve_instances(
+            name,
+            zone=request.args.get('zone'),
+            version=request.args.get('version'),
+            tags=request.args.getlist('tag')
+        )
+    except Exception as e:
+        logger.error(f"Error resolving service {name}: {e}")
+        return jsonify({'message': 'Service resolution failed'}), 503
+    return jsonify({
+        'service': name,
+        'instances': instances,
+        'total_weight': sum(instance['weight'] for instance in instances)
+    }), 200
 
 # POST Provision Endpoint
 @app.route('/services', methods=['POST'])
@@ -185,58 +735,67 @@ def add_service(user=None, access=None):
     if user != "admin":
         return jsonify({'message': 'Unauthorized '}), 401
     
-    new_service = request.get_json()
-    
-    name = new_service.get('name')
-    description = new_service.get('description')
-    url = new_service.get('url')
-    
-    sql = """
-    INSERT INTO services (id,name, description, url)
-    VALUES (%s,%s, %s, %s);
-    """
-    sql2 = """
-    INSERT INTO users (username,password_hash,write_access)
-    VALUES (%s,%s,'SELF');
-    """
-    uuid_arg = str(uuid.uuid4())
-    password = secrets.token_urlsafe(32)
-    conn = get_reg_db_conn()
-    cursor = conn.cursor()
-    cursor.execute(sql, (uuid_arg,name,description,url))    
-    cursor.execute(sql2,(uuid_arg,bcrypt.hashpw((password).encode('utf-8'), PW_SALT,)))
-    conn.commit()
-    
-    cursor.close()
-    conn.close()
-    return jsonify({'message': f'Service added successfully',"UUID": uuid_arg, "password": password}), 201
-
-
-
-def remove_service_from_database(service_uuid):
-    sql = """
-    DELETE FROM services
-    WHERE id = %s;
-    """
-    sql2 = """
-    DELETE FROM users
-    WHERE username = %s;
-    """
-    conn = get_reg_db_conn()
-    cursor = conn.cursor()
-    cursor.execute(sql, [service_uuid])
-    cursor.execute(sql2, [service_uuid])
-    rowcount = cursor.rowcount
-    if rowcount < 1:
-        conn.rollback()
-        cursor.close()
-        conn.close()
-        return False
-    else:
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
+    registration, error = parse_service_registration(request.get_json())
+    if error:
+        return jsonify({'message': error}), 400
+    insert_services_into_database([registration], [hash_password(registration['password'])])
+    response = registration_response(registration)
+    response['message'] = f'Service added successfully'
+    return jsonify(response), 201
+
+# POST Batch provision Endpoint
+# Body is a JSON array of services; valid items are written in one
+# transaction and every item gets its own result in the same order
+@app.route('/services/batch', methods=['POST'])
+@auth_required
+def add_services_batch(user=None, access=None):
+    if user != "admin":
+        return jsonify({'message': 'Unauthorized '}), 401
+    items = request.get_json()
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'Expected a non-empty JSON array'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'message': f'At most {BATCH_MAX_ITEMS} items per batch'}), 400
+    results = []
+    registrations = []
+    for item in items:
+        registration, error = parse_service_registration(item)
+        if error:
+            results.append({'status': 400, 'message': error})
+            continue
+        results.append(registration)
+        registrations.append(registration)
+    if registrations:
+        with profiler.span('bcrypt'):
+            password_hashes = list(hash_executor.map(
+                hash_password, [reg['password'] for reg in registrations]
+            ))
+        insert_services_into_database(registrations, password_hashes)
+    # Repeats of one (name, url), as the database compares names, share a
+    # row; the storage keeps the last one's credentials, so all get those
+    stored = {registration['id']: registration for registration in registrations}
+    results = [
+        dict(registration_response(stored[result['id']]), status=201) if 'password' in result else result
+        for result in results
+    ]
+    failed = sum(1 for result in results if result.get('status') == 400)
+    return jsonify({'results': results}), 207 if failed else 201
+
+
+
+def remove_service_from_database(service_uuid, reason='deregister'):
+    removed = storage.remove_service(service_uuid, reason)
+    if removed:
+        catalog.invalidate()
+    return removed
+
+def remove_services_from_database(service_uuids, reason='deregister'):
+    if not service_uuids:
+        return set()
+    removed = storage.remove_services(service_uuids, reason)
+    if removed:
+        catalog.invalidate()
+    return removed
 # DELETE Deprovision Endpoint
 @app.route('/services', methods=['DELETE'])
 @auth_required
@@ -249,9 +808,115 @@ def remove_service(user=None, access=None):
         return jsonify({'error': f'Service with UUID: {service_uuid} not found.'}), 404
     else:
         return jsonify({'message': 'Service removed successfully'}), 200
+
+# DELETE Batch deprovision Endpoint
+# Body is a JSON array of ids (or objects with an "id")
+@app.route('/services/batch', methods=['DELETE'])
+@auth_required
+def remove_services_batch(user=None, access=None):
+    items = request.get_json()
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'Expected a non-empty JSON array'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'message': f'At most {BATCH_MAX_ITEMS} items per batch'}), 400
+    service_uuids = [item.get('id') if isinstance(item, dict) else item for item in items]
+    allowed = [
+        service_uuid for service_uuid in service_uuids
+        if isinstance(service_uuid, str) and access != "NONE" and not (access == "SELF" and service_uuid != user)
+    ]
+    removed = remove_services_from_database(list(dict.fromkeys(allowed)))
+    results = []
+    for service_uuid in service_uuids:
+        if not isinstance(service_uuid, str):
+            results.append({'id': service_uuid, 'status': 400, 'message': 'id must be a string'})
+        elif service_uuid not in allowed:
+            results.append({'id': service_uuid, 'status': 401, 'message': 'Unauthorized'})
+        elif service_uuid in removed:
+            results.append({'id': service_uuid, 'status': 200, 'message': 'Service removed successfully'})
+        else:
+            results.append({'id': service_uuid, 'status': 404, 'message': 'Service not found'})
+    all_removed = all(result['status'] == 200 for result in results)
+    return jsonify({'results': results}), 200 if all_removed else 207
     
 
 
+# GET Delta sync Endpoint
+# Returns the changes after revision ?since=N, or 410 with resync=true when N
+# is no longer in the change log and the client must reload GET /services
+@app.route('/services/changes')
+def get_service_changes():
+    try:
+        since = int(request.args.get('since', ''))
+        limit = int(request.args.get('limit', CHANGES_PAGE_MAX))
+    except ValueError:
+        return jsonify({'message': 'since and limit must be integers'}), 400
+    if since < 0 or limit < 1 or limit > CHANGES_PAGE_MAX:
+        return jsonify({'message': f'since must be >= 0 and limit between 1 and {CHANGES_PAGE_MAX}'}), 400
+    if 'wait' in request.args:
+        try:
+            wait = parse_wait(request.args['wait'])
+        except ValueError:
+            return jsonify({'message': 'wait must be a duration like 30s'}), 400
+        if not watch_slots.acquire(blocking=False):
+            return watch_slots_full()
+        try:
+            catalog.wait(since, max(0.0, min(wait, WATCH_MAX_WAIT)))
+        except Exception as e:
+            logger.error(f"Error loading service catalog: {e}")
+        finally:
+            watch_slots.release()
+    try:
+        revision, page = storage.fetch_changes(since, limit)
+    except Exception as e:
+        logger.error(f"Error fetching catalog changes: {e}")
+        return jsonify({'message': 'Change log unavailable'}), 503
+    if page is None:
+        return jsonify({'resync': True, 'revision': revision}), 410
+    upper, changes = page
+    return jsonify({
+        'revision': upper,
+        'changes': changes,
+        'more': upper < revision
+    }), 200
+
+# PUT Lease renewal (heartbeat) Endpoint
+@app.route('/services/heartbeat', methods=['PUT'])
+@auth_required
+def renew_lease(user=None, access=None):
+    service_uuid = request.get_json().get('id')
+    if access == "NONE" or (access == "SELF" and service_uuid != user):
+        return jsonify({'message': 'Unauthorized '}), 401
+    renewed = storage.renew_lease(service_uuid)
+    if not renewed:
+        return jsonify({'error': f'No active lease for service with UUID: {service_uuid}.'}), 404
+    return jsonify({'message': 'Lease renewed'}), 200
+
+# While the database is unreachable the registry is read-only: reads are
+# served from the last known-good catalog and writes fail fast
+@app.errorhandler(mysql.connector.Error)
+@app.errorhandler(sqlite3.Error)
+def database_unavailable(e):
+    logger.error(f"Database error: {e}")
+    return jsonify({'message': 'Registry database unavailable, the registry is read-only'}), 503
+
+# GET Pool statistics
+@app.route('/stats/pool')
+def get_pool_stats():
+    return jsonify(storage.stats()), 200
+
+# GET Last health sweep statistics
+@app.route('/stats/health')
+def get_health_stats():
+    # As last published by the leader on this host; published_at tells how
+    # fresh it is, as another replica may have taken over the leadership
+    if HEALTH_STATS_PATH:
+        try:
+            with open(HEALTH_STATS_PATH) as f:
+                return jsonify(app.json.loads(f.read())), 200
+        except (OSError, ValueError):
+            pass
+    return jsonify(local_health_stats()), 200
+
 @app.route("/", methods=["GET"])
 def serve_react_app():
     return send_from_directory(app.static_folder, 'index.html')
@@ -3,11 +3,40 @@ CREATE TABLE IF NOT EXISTS services (
     id CHAR(36) NOT NULL PRIMARY KEY,
     name VARCHAR(255) NOT NULL,
     description TEXT, 
-    url VARCHAR(2048) );    
+    url VARCHAR(2048),
+    url_hash CHAR(64) AS (SHA2(url, 256)) STORED,
+    status VARCHAR(16) NOT NULL DEFAULT 'healthy',
+    weight INT UNSIGNED NOT NULL DEFAULT 100,
+    zone VARCHAR(64) NULL,
+    version VARCHAR(64) NULL,
+    lease_ttl INT UNSIGNED NULL,
+    expires_at DATETIME(3) NULL,
+    UNIQUE INDEX uq_services_identity (name, url_hash),
+    INDEX idx_services_resolve (name, status, zone),
+    INDEX idx_services_status (status, id),
+    INDEX idx_services_expires_at (expires_at) );    
+CREATE TABLE IF NOT EXISTS service_tags (
+    service_id CHAR(36) NOT NULL,
+    tag VARCHAR(64) NOT NULL,
+    PRIMARY KEY (service_id, tag),
+    INDEX idx_service_tags_tag (tag, service_id),
+    FOREIGN KEY (service_id) REFERENCES services(id) ON DELETE CASCADE );
 CREATE TABLE IF NOT EXISTS users (
     username VARCHAR(255) NOT NULL PRIMARY KEY, 
     password_hash VARCHAR(255) NOT NULL,
     write_access VARCHAR(10) DEFAULT 'NONE');
+CREATE TABLE IF NOT EXISTS catalog_state (
+    id TINYINT NOT NULL PRIMARY KEY,
+    revision BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    compacted_revision BIGINT UNSIGNED NOT NULL DEFAULT 0);
+INSERT INTO catalog_state (id, revision) VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS catalog_changes (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    revision BIGINT UNSIGNED NOT NULL,
+    op VARCHAR(16) NOT NULL,
+    service_id CHAR(36) NOT NULL,
+    service TEXT,
+    INDEX idx_catalog_changes_revision (revision) );
 INSERT INTO users (username, password_hash, write_access)
 VALUES (
     'admin',
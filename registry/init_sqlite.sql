@@ -0,0 +1,45 @@
+-- SQLite version of init.sql, applied by SQLiteStorage on startup
+CREATE TABLE IF NOT EXISTS services (
+    id CHAR(36) NOT NULL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL COLLATE NOCASE,
+    description TEXT,
+    url VARCHAR(2048),
+    url_hash CHAR(64),
+    status VARCHAR(16) NOT NULL DEFAULT 'healthy',
+    weight INTEGER NOT NULL DEFAULT 100,
+    zone VARCHAR(64) NULL,
+    version VARCHAR(64) NULL,
+    lease_ttl INTEGER NULL,
+    expires_at TEXT NULL );
+CREATE UNIQUE INDEX IF NOT EXISTS uq_services_identity ON services (name, url_hash);
+CREATE INDEX IF NOT EXISTS idx_services_resolve ON services (name, status, zone);
+CREATE INDEX IF NOT EXISTS idx_services_status ON services (status, id);
+CREATE INDEX IF NOT EXISTS idx_services_expires_at ON services (expires_at);
+CREATE TABLE IF NOT EXISTS service_tags (
+    service_id CHAR(36) NOT NULL,
+    tag VARCHAR(64) NOT NULL,
+    PRIMARY KEY (service_id, tag),
+    FOREIGN KEY (service_id) REFERENCES services(id) ON DELETE CASCADE );
+CREATE INDEX IF NOT EXISTS idx_service_tags_tag ON service_tags (tag, service_id);
+CREATE TABLE IF NOT EXISTS users (
+    username VARCHAR(255) NOT NULL PRIMARY KEY,
+    password_hash VARCHAR(255) NOT NULL,
+    write_access VARCHAR(10) DEFAULT 'NONE');
+CREATE TABLE IF NOT EXISTS catalog_state (
+    id INTEGER NOT NULL PRIMARY KEY,
+    revision INTEGER NOT NULL DEFAULT 0,
+    compacted_revision INTEGER NOT NULL DEFAULT 0);
+INSERT OR IGNORE INTO catalog_state (id, revision) VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS catalog_changes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    revision INTEGER NOT NULL,
+    op VARCHAR(16) NOT NULL,
+    service_id CHAR(36) NOT NULL,
+    service TEXT );
+CREATE INDEX IF NOT EXISTS idx_catalog_changes_revision ON catalog_changes (revision);
+INSERT OR IGNORE INTO users (username, password_hash, write_access)
+VALUES (
+    'admin',
+    '$2b$12$YWtcqFBtYJZp6w8IrhInZeaV5n399APutEKhbW/PNeo5DADlsIA0e',
+    'FULL'
+);
@@ -0,0 +1,111 @@
+import os
+import fcntl
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MySQLLeaderLock(object):
+    # Leadership is a MySQL named lock held on a dedicated connection. The
+    # server releases it as soon as that session ends, so if the leader dies
+    # another process wins GET_LOCK on its next attempt.
+    def __init__(self, name, connect):
+        self.name = name
+        self._connect = connect
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _drop(self):
+        conn, self._conn = self._conn, None
+        if conn is not None and self._pid == os.getpid():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _still_held(self):
+        try:
+            cursor = self._conn.cursor()
+            cursor.execute("SELECT IS_USED_LOCK(%s) = CONNECTION_ID();", (self.name,))
+            row = cursor.fetchone()
+            cursor.close()
+            return bool(row and row[0])
+        except Exception as e:
+            logger.warning(f"Lost leader lock connection: {e}")
+            return False
+
+    def is_leader(self):
+        with self._lock:
+            if self._conn is not None and self._pid != os.getpid():
+                # Never share the parent's session after a fork
+                self._conn = None
+            if self._conn is not None:
+                if self._still_held():
+                    return True
+                self._drop()
+                logger.info(f"Lost leadership of '{self.name}'")
+            try:
+                conn = self._connect()
+                cursor = conn.cursor()
+                cursor.execute("SELECT GET_LOCK(%s, 0);", (self.name,))
+                row = cursor.fetchone()
+                cursor.close()
+            except Exception as e:
+                logger.error(f"Leader election failed: {e}")
+                return False
+            if row and row[0] == 1:
+                self._conn = conn
+                self._pid = os.getpid()
+                logger.info(f"Acquired leadership of '{self.name}' in pid {self._pid}")
+                return True
+            conn.close()
+            return False
+
+    def held(self):
+        return self._conn is not None and self._pid == os.getpid()
+
+    def release(self):
+        with self._lock:
+            self._drop()
+
+
+class FileLeaderLock(object):
+    # Single-host alternative: an exclusive flock on a shared file. The
+    # kernel drops the lock when the holding process exits.
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def is_leader(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                return True
+            if self._fd is not None:
+                # Close the copy inherited across fork without unlocking, the
+                # parent still owns the lock through its own descriptor.
+                os.close(self._fd)
+                self._fd = None
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._fd = fd
+            self._pid = os.getpid()
+            logger.info(f"Acquired leadership via {self.path} in pid {self._pid}")
+            return True
+
+    def held(self):
+        return self._fd is not None and self._pid == os.getpid()
+
+    def release(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,320 @@
+import os
+import math
+import mmap
+import fcntl
+import random
+import struct
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKENDS = 64
+MAX_WORKERS = 64
+# Round-robin cursor and the number of worker rows handed out
+HEADER = struct.Struct("<QQ")
+NAME = struct.Struct("<64s")
+# Latency EWMA in seconds, when it was last updated, requests sent
+STATS = struct.Struct("<ddQ")
+# Circuit breaker counters: consecutive errors, when the error-rate window
+# started, requests and errors in it
+COUNTS = struct.Struct("<qdqq")
+# Ejected until (0 while the breaker is closed), half-open probe claimed
+# until, number of ejections in a row
+EJECTION = struct.Struct("<ddq")
+BACKEND_SIZE = NAME.size + STATS.size + COUNTS.size + EJECTION.size
+PID = struct.Struct("<Q")
+INFLIGHT = struct.Struct("<q")
+ROW_SIZE = PID.size + MAX_BACKENDS * INFLIGHT.size
+# How long a worker found alive (or dead) is taken as such
+LIVENESS_TTL = 1.0
+
+
+class SharedStats(object):
+    # Per-backend load shared by all balancer workers through a mapped file.
+    # In-flight counts are kept per worker: each worker only writes its own
+    # row and readers add the rows up, so no increment is ever lost. The
+    # latency EWMA is one cell per backend that any worker may update; two
+    # racing updates can drop a sample, which an average shrugs off.
+    # Slots are handed out under an flock, which only happens the first time
+    # a worker starts or sees a backend. The slots also hold the circuit
+    # breaker state: counters are written without the lock, ejections only
+    # under it.
+    def __init__(self, path, decay=10.0):
+        self.path = path
+        self.decay = decay
+        size = HEADER.size + MAX_BACKENDS * BACKEND_SIZE + MAX_WORKERS * ROW_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._slots = {}
+        self._pid = None
+        self._row = None
+        self._liveness = {}
+        # The threads of one worker share its row
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self):
+        # A fresh open file per call: flocks belong to the open file, which
+        # a forked worker would otherwise share with its parent
+        with open(f"{self.path}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    def _live(self, pid):
+        # _alive() with a short cache, as inflight() runs for every backend
+        # on every request
+        now = time.monotonic()
+        cached = self._liveness.get(pid)
+        if cached is None or now - cached[1] > LIVENESS_TTL:
+            if len(self._liveness) > 4 * MAX_WORKERS:
+                self._liveness = {}
+            cached = (self._alive(pid), now)
+            self._liveness[pid] = cached
+        return cached[0]
+
+    def _row_offset(self, row):
+        return HEADER.size + MAX_BACKENDS * BACKEND_SIZE + row * ROW_SIZE
+
+    def _worker_row(self):
+        # Claims a row on first use in each process, taking over the row of
+        # an exited worker (and dropping the requests it left in flight)
+        if self._pid == os.getpid():
+            return self._row
+        with self.lock():
+            cursor, rows = HEADER.unpack_from(self._map)
+            row = None
+            for candidate in range(MAX_WORKERS):
+                offset = self._row_offset(candidate)
+                pid = PID.unpack_from(self._map, offset)[0]
+                if pid == 0 or not self._alive(pid):
+                    row = candidate
+                    self._map[offset:offset + ROW_SIZE] = bytes(ROW_SIZE)
+                    PID.pack_into(self._map, offset, os.getpid())
+                    HEADER.pack_into(self._map, 0, cursor, max(rows, row + 1))
+                    break
+        if row is None:
+            logger.warning(f"No free worker row in {self.path}, in-flight counts of this worker are not shared")
+        self._pid = os.getpid()
+        self._row = row
+        return row
+
+    def _backend_offset(self, slot):
+        return HEADER.size + slot * BACKEND_SIZE
+
+    def _slot(self, backend):
+        # Also caches a backend without a slot, so a lookup takes the lock
+        # at most once per backend and process
+        if backend in self._slots:
+            return self._slots[backend]
+        name = backend.encode("utf-8")[:NAME.size]
+        slot = None
+        with self.lock():
+            free = None
+            for candidate in range(MAX_BACKENDS):
+                offset = self._backend_offset(candidate)
+                existing = NAME.unpack_from(self._map, offset)[0].rstrip(b"\0")
+                if existing == name:
+                    slot = candidate
+                    break
+                if not existing and free is None:
+                    free = candidate
+            if slot is None and free is not None:
+                slot = free
+                offset = self._backend_offset(slot)
+                self._map[offset:offset + BACKEND_SIZE] = bytes(BACKEND_SIZE)
+                NAME.pack_into(self._map, offset, name)
+        if slot is None:
+            logger.warning(f"No free backend slot in {self.path} for {backend}")
+        self._slots[backend] = slot
+        return slot
+
+    def _inflight_offset(self, backend):
+        row = self._worker_row()
+        slot = self._slot(backend)
+        if row is None or slot is None:
+            return None
+        return self._row_offset(row) + PID.size + slot * INFLIGHT.size
+
+    def next_index(self):
+        cursor, rows = HEADER.unpack_from(self._map)
+        HEADER.pack_into(self._map, 0, cursor + 1, rows)
+        return cursor
+
+    def _add_inflight(self, backend, amount):
+        offset = self._inflight_offset(backend)
+        if offset is None:
+            return
+        with self._lock:
+            INFLIGHT.pack_into(self._map, offset, INFLIGHT.unpack_from(self._map, offset)[0] + amount)
+
+    def start(self, backend):
+        self._add_inflight(backend, 1)
+
+    def finish(self, backend):
+        self._add_inflight(backend, -1)
+
+    def observe(self, backend, seconds):
+        # Peak EWMA: a slower response is taken at once, faster ones pull the
+        # average down with a time constant of decay seconds
+        slot = self._slot(backend)
+        if slot is None:
+            return
+        offset = self._backend_offset(slot) + NAME.size
+        ewma, updated_at, requests = STATS.unpack_from(self._map, offset)
+        now = time.time()
+        if seconds > ewma:
+            ewma = seconds
+        else:
+            weight = math.exp(-max(0.0, now - updated_at) / self.decay)
+            ewma = ewma * weight + seconds * (1 - weight)
+        STATS.pack_into(self._map, offset, ewma, now, requests + 1)
+
+    def inflight(self, backend):
+        slot = self._slot(backend)
+        if slot is None:
+            return 0
+        rows = HEADER.unpack_from(self._map)[1]
+        total = 0
+        for row in range(rows):
+            offset = self._row_offset(row)
+            # The row of a worker that crashed or was recycled keeps the
+            # requests it had in flight until another worker claims it
+            pid = PID.unpack_from(self._map, offset)[0]
+            if pid and self._live(pid):
+                total += INFLIGHT.unpack_from(self._map, offset + PID.size + slot * INFLIGHT.size)[0]
+        return max(0, total)
+
+    def latency(self, backend):
+        slot = self._slot(backend)
+        if slot is None:
+            return 0.0
+        return STATS.unpack_from(self._map, self._backend_offset(slot) + NAME.size)[0]
+
+    def counts(self, backend):
+        slot = self._slot(backend)
+        if slot is None:
+            return None
+        return COUNTS.unpack_from(self._map, self._backend_offset(slot) + NAME.size + STATS.size)
+
+    def set_counts(self, backend, consecutive, window_start, requests, errors):
+        slot = self._slot(backend)
+        if slot is not None:
+            offset = self._backend_offset(slot) + NAME.size + STATS.size
+            COUNTS.pack_into(self._map, offset, consecutive, window_start, requests, errors)
+
+    def ejection(self, backend):
+        slot = self._slot(backend)
+        if slot is None:
+            return 0.0, 0.0, 0
+        return EJECTION.unpack_from(self._map, self._backend_offset(slot) + NAME.size + STATS.size + COUNTS.size)
+
+    def set_ejection(self, backend, ejected_until, probe_until, ejections):
+        # Callers hold lock(), so the slot must already be known: claiming
+        # one takes the lock again
+        slot = self._slots.get(backend)
+        if slot is not None:
+            offset = self._backend_offset(slot) + NAME.size + STATS.size + COUNTS.size
+            EJECTION.pack_into(self._map, offset, ejected_until, probe_until, ejections)
+
+
+def rotate(backends, first):
+    # The chosen backend, then the rest in order for failover
+    return [first] + [backend for backend in backends if backend != first]
+
+
+class RoundRobin(object):
+    def __init__(self, stats, weight):
+        self.stats = stats
+
+    def order(self, backends):
+        start = self.stats.next_index() % len(backends)
+        return list(backends[start:]) + list(backends[:start])
+
+
+class WeightedRoundRobin(object):
+    # Smooth weighted round-robin (as in nginx): every backend gains its
+    # weight each pick, the highest is chosen and loses the total, which
+    # interleaves picks instead of sending bursts to the heaviest backend.
+    # The rotation is per worker; across workers the shares still hold.
+    def __init__(self, stats, weight):
+        self.weight = weight
+        self._lock = threading.Lock()
+        self._current = {}
+
+    def order(self, backends):
+        with self._lock:
+            total = 0
+            best = None
+            for backend in backends:
+                weight = self.weight(backend)
+                self._current[backend] = self._current.get(backend, 0) + weight
+                total += weight
+                if best is None or self._current[backend] > self._current[best]:
+                    best = backend
+            self._current[best] -= total
+        return rotate(backends, best)
+
+
+class LeastOutstanding(object):
+    def __init__(self, stats, weight):
+        self.stats = stats
+
+    def order(self, backends):
+        # Random tie-break so idle backends share the load
+        return sorted(backends, key=lambda backend: (self.stats.inflight(backend), random.random()))
+
+
+class PowerOfTwoChoices(object):
+    # Compares two random backends instead of all of them, so workers that
+    # read the same stats do not all pile onto the same "best" backend
+    def __init__(self, stats, weight):
+        self.stats = stats
+
+    def cost(self, backend):
+        return self.stats.inflight(backend)
+
+    def order(self, backends):
+        if len(backends) < 2:
+            return list(backends)
+        first, second = random.sample(list(backends), 2)
+        return rotate(backends, first if self.cost(first) <= self.cost(second) else second)
+
+
+class PeakEwma(PowerOfTwoChoices):
+    # Expected wait: the peak EWMA latency times the requests queued ahead.
+    # A backend without samples costs nothing, so it gets probed at once.
+    def cost(self, backend):
+        return self.stats.latency(backend) * (self.stats.inflight(backend) + 1)
+
+
+STRATEGIES = {
+    'round_robin': RoundRobin,
+    'weighted_round_robin': WeightedRoundRobin,
+    'least_outstanding': LeastOutstanding,
+    'p2c': PowerOfTwoChoices,
+    'peak_ewma': PeakEwma,
+}
+
+
+def create_strategy(name, stats, weight=lambda backend: 1):
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown balancing strategy {name}, expected one of {sorted(STRATEGIES)}")
+    return STRATEGIES[name](stats, weight)
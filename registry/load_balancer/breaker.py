@@ -0,0 +1,137 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreakers(object):
+    # Outlier ejection per backend, shared by all workers through the stats
+    # file so a backend ejected by one worker is skipped by every worker.
+    # A backend is ejected after consecutive_errors failures in a row, or
+    # when at least min_requests in the last window seconds failed at
+    # error_rate or worse. It stays out for ejection_time seconds, doubled
+    # with each ejection in a row up to max_ejection_time. Then the breaker
+    # is half-open: a single request (probe_timeout seconds to claim it) is
+    # let through, a success closes it and a failure ejects it again. At
+    # most max_ejection_percent of the backends are out at once, so an
+    # outage of every instance does not leave the balancer with none.
+    def __init__(self, stats, backends, consecutive_errors=5, error_rate=0.5, min_requests=20, window=10.0,
+                 ejection_time=30.0, max_ejection_time=300.0, max_ejection_percent=50, probe_timeout=10.0,
+                 on_eject=None):
+        self.stats = stats
+        self.backends = backends
+        self.consecutive_errors = consecutive_errors
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.max_ejection_percent = max_ejection_percent
+        self.probe_timeout = probe_timeout
+        self._on_eject = on_eject or (lambda backend: None)
+
+    def ejected(self, backend):
+        return self.stats.ejection(backend)[0] > 0
+
+    def _claim_probe(self, backend, now):
+        with self.stats.lock():
+            ejected_until, probe_until, ejections = self.stats.ejection(backend)
+            if ejected_until == 0 or now < ejected_until:
+                return ejected_until == 0
+            if now < probe_until:
+                return False
+            self.stats.set_ejection(backend, ejected_until, now + self.probe_timeout, ejections)
+        logger.info(f"Probing ejected backend {backend}")
+        return True
+
+    def select(self, ordered):
+        # The backends of ordered a request may use, in order. A half-open
+        # backend whose probe this request claimed goes first; if everything
+        # is ejected the whole list is returned rather than none.
+        now = time.time()
+        closed = []
+        probe = None
+        for backend in ordered:
+            ejected_until, probe_until, _ = self.stats.ejection(backend)
+            if ejected_until == 0:
+                closed.append(backend)
+            elif probe is None and now >= ejected_until and now >= probe_until and self._claim_probe(backend, now):
+                probe = backend
+        selected = ([probe] if probe else []) + closed
+        return selected or list(ordered)
+
+    def _count(self, backend, failed, now):
+        counts = self.stats.counts(backend)
+        if counts is None:
+            return None
+        consecutive, window_start, requests, errors = counts
+        if now - window_start > self.window:
+            if requests and not errors:
+                self._forgive(backend)
+            window_start, requests, errors = now, 0, 0
+        consecutive = consecutive + 1 if failed else 0
+        requests += 1
+        errors += 1 if failed else 0
+        self.stats.set_counts(backend, consecutive, window_start, requests, errors)
+        return consecutive, requests, errors
+
+    def _forgive(self, backend):
+        # A window without errors resets the ejections in a row
+        if self.stats.ejection(backend)[2] == 0:
+            return
+        with self.stats.lock():
+            if self.stats.ejection(backend)[0] == 0:
+                self.stats.set_ejection(backend, 0.0, 0.0, 0)
+
+    def success(self, backend):
+        now = time.time()
+        self._count(backend, False, now)
+        ejected_until = self.stats.ejection(backend)[0]
+        if ejected_until == 0 or now < ejected_until:
+            return
+        with self.stats.lock():
+            ejected_until, _, ejections = self.stats.ejection(backend)
+            if ejected_until == 0 or now < ejected_until:
+                return
+            self.stats.set_ejection(backend, 0.0, 0.0, ejections)
+        logger.info(f"Backend {backend} is healthy again")
+
+    def failure(self, backend):
+        now = time.time()
+        counts = self._count(backend, True, now)
+        if counts is None:
+            return
+        consecutive, requests, errors = counts
+        ejected_until = self.stats.ejection(backend)[0]
+        if ejected_until:
+            # Still ejected: only a failed probe counts
+            if now >= ejected_until:
+                self._eject(backend, now, "probe failed")
+            return
+        if consecutive >= self.consecutive_errors:
+            self._eject(backend, now, f"{consecutive} consecutive errors")
+        elif requests >= self.min_requests and errors >= self.error_rate * requests:
+            self._eject(backend, now, f"{errors} of {requests} requests failed")
+
+    def _eject(self, backend, now, reason):
+        backends = self.backends()
+        # Read before taking the lock, which looking up a backend may need
+        others = [other for other in backends if other != backend and self.ejected(other)]
+        with self.stats.lock():
+            ejected_until, _, ejections = self.stats.ejection(backend)
+            if 0 < now < ejected_until:
+                return
+            if not ejected_until:
+                ejected = len(others)
+                if (ejected + 1) * 100 > self.max_ejection_percent * max(len(backends), 1):
+                    logger.warning(f"Not ejecting backend {backend} ({reason}): "
+                                   f"{ejected} of {len(backends)} already ejected")
+                    self.stats.set_counts(backend, 0, now, 0, 0)
+                    return
+            # The exponent is capped first: a float times 2 ** 1024 overflows
+            seconds = min(self.ejection_time * 2 ** min(ejections, 20), self.max_ejection_time)
+            self.stats.set_ejection(backend, now + seconds, 0.0, ejections + 1)
+            # Start the next error-rate window from scratch
+            self.stats.set_counts(backend, 0, now, 0, 0)
+        logger.warning(f"Ejected backend {backend} for {seconds:.0f}s: {reason}")
+        self._on_eject(backend)
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Containers with a healthcheck only receive traffic once it passes
+NOT_READY = ('starting', 'unhealthy')
+
+
+def container_weight(container, label):
+    try:
+        return max(1, int(container.labels.get(label, 1)))
+    except (TypeError, ValueError):
+        return 1
+
+
+class BackendDiscovery(object):
+    # The registry containers the balancer forwards to, kept in memory so the
+    # request path never calls the Docker API. The set is listed once on
+    # start(), then kept current from the Docker events stream (start, die
+    # and health_status), and listed again every reconcile_interval seconds
+    # and after the stream reconnects in case an event was missed.
+    # on_change is called with the new set whenever it changes. A container
+    # label (weight_label) sets a backend's weight for weighted balancing.
+    def __init__(self, client, labels, reconcile_interval=30, retry_interval=2, on_change=None,
+                 weight_label='lb.weight'):
+        self.client = client
+        self.labels = list(labels)
+        self.reconcile_interval = reconcile_interval
+        self.retry_interval = retry_interval
+        self._on_change = on_change or (lambda backends: None)
+        self.weight_label = weight_label
+        self._weights = {}
+        self._lock = threading.Lock()
+        # Replaced, never mutated, so readers need no lock
+        self._backends = ()
+        self._threads = []
+
+    @property
+    def backends(self):
+        return self._backends
+
+    def weight(self, backend):
+        return self._weights.get(backend, 1)
+
+    def _set(self, names):
+        backends = tuple(sorted(names))
+        if backends == self._backends:
+            return
+        logger.info(f"Registry backends: {list(backends)}")
+        self._backends = backends
+        self._on_change(backends)
+
+    def reconcile(self):
+        containers = self.client.containers.list(filters={'label': self.labels, 'status': 'running'})
+        ready = [c for c in containers if c.health not in NOT_READY]
+        with self._lock:
+            self._weights = {c.name.lstrip('/'): container_weight(c, self.weight_label) for c in ready}
+            self._set(c.name.lstrip('/') for c in ready)
+        return self._backends
+
+    def _add(self, name):
+        with self._lock:
+            self._set(set(self._backends) | {name})
+
+    def _remove(self, name):
+        with self._lock:
+            self._set(set(self._backends) - {name})
+
+    def _apply(self, event):
+        action = event.get('Action') or event.get('status') or ''
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        name = attributes.get('name', '').lstrip('/')
+        if not name:
+            return
+        if action == 'start':
+            # A container with a healthcheck starts out "starting"
+            try:
+                container = self.client.containers.get(name)
+                ready = container.health not in NOT_READY
+                self._weights[name] = container_weight(container, self.weight_label)
+            except Exception as e:
+                logger.warning(f"Could not inspect started container {name}: {e}")
+                ready = True
+            if ready:
+                self._add(name)
+        elif action == 'die':
+            self._remove(name)
+        elif action.startswith('health_status'):
+            if action.split(':')[-1].strip() == 'healthy':
+                self._add(name)
+            else:
+                self._remove(name)
+
+    def _watch(self):
+        filters = {'type': 'container', 'label': self.labels, 'event': ['start', 'die', 'health_status']}
+        while True:
+            try:
+                events = self.client.events(decode=True, filters=filters)
+                # Events from before the subscription are covered by listing
+                # the containers again
+                self.reconcile()
+                for event in events:
+                    self._apply(event)
+                logger.warning("Docker events stream ended, reconnecting")
+            except Exception as e:
+                logger.error(f"Docker events stream failed: {e}")
+            time.sleep(self.retry_interval)
+
+    def _reconcile_loop(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error(f"Backend reconcile failed: {e}")
+
+    def start(self):
+        try:
+            self.reconcile()
+        except Exception as e:
+            logger.error(f"Initial backend listing failed: {e}")
+        for target, name in ((self._watch, 'docker-events'), (self._reconcile_loop, 'reconcile')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
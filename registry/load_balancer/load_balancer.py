@@ -1,77 +1,273 @@
 from flask import Flask, jsonify, request
-import requests 
 import uuid
 import docker
 import jwt
 from datetime import datetime, timezone, timedelta
 from functools import wraps
 import os
+import time
+import logging
+
+from metrics import MetricsRegistry, instrument_app
+from discovery import BackendDiscovery
+from upstream import UpstreamPools, StreamedBody, end_to_end
+from balancer import SharedStats, create_strategy
+from breaker import CircuitBreakers
+from urllib3.exceptions import HTTPError
 
 PORT = "4152"
+METRICS_DIR = os.getenv("METRICS_DIR", "/tmp/lb_metrics")
+RECONCILE_INTERVAL = float(os.getenv("LB_RECONCILE_INTERVAL", "30"))
+POOL_MAXSIZE = int(os.getenv("LB_POOL_MAXSIZE", "32"))
+# Unset: past LB_POOL_MAXSIZE extra connections are opened and not kept
+POOL_BLOCK_TIMEOUT = float(os.getenv("LB_POOL_BLOCK_TIMEOUT")) if os.getenv("LB_POOL_BLOCK_TIMEOUT") else None
+# Must stay below the registry's GUNICORN_KEEPALIVE
+POOL_IDLE_TIMEOUT = float(os.getenv("LB_POOL_IDLE_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.getenv("LB_CONNECT_TIMEOUT", "2"))
+# A backend that accepts connections but never answers fails after this
+READ_TIMEOUT = float(os.getenv("LB_READ_TIMEOUT", "30"))
+# Watch requests (index/wait) block on the registry for up to their wait,
+# as the registry defaults and caps it, so they get that plus a margin
+WATCH_DEFAULT_WAIT = float(os.getenv("LB_WATCH_DEFAULT_WAIT", "30"))
+WATCH_MAX_WAIT = float(os.getenv("LB_WATCH_MAX_WAIT", "300"))
+WATCH_TIMEOUT_MARGIN = float(os.getenv("LB_WATCH_TIMEOUT_MARGIN", "10"))
+# Responses are relayed in chunks of this size, so a request holds at most
+# one chunk in memory whatever the payload size
+STREAM_CHUNK_SIZE = int(os.getenv("LB_STREAM_CHUNK_SIZE", "65536"))
+# Request bodies up to this size are read first so the request can fail over
+# to another backend; larger ones are streamed through to a single backend
+RETRY_BODY_MAX = int(os.getenv("LB_RETRY_BODY_MAX", "65536"))
+# round_robin, weighted_round_robin, least_outstanding, p2c or peak_ewma
+STRATEGY = os.getenv("LB_STRATEGY", "round_robin")
+# In-flight counts and latencies shared by the gunicorn workers
+STATS_PATH = os.getenv("LB_STATS_PATH", "/dev/shm/lb_stats")
+# Seconds for the latency EWMA to forget a slow response
+EWMA_DECAY = float(os.getenv("LB_EWMA_DECAY", "10"))
+# Container label with a backend's weight for weighted_round_robin
+WEIGHT_LABEL = os.getenv("LB_WEIGHT_LABEL", "lb.weight")
+# Other backends a failed request is retried on
+MAX_RETRIES = int(os.getenv("LB_MAX_RETRIES", "2"))
+# A backend is ejected after this many errors in a row, or when at least
+# LB_EJECT_MIN_REQUESTS in LB_EJECT_WINDOW seconds failed at LB_EJECT_ERROR_RATE
+EJECT_CONSECUTIVE_ERRORS = int(os.getenv("LB_EJECT_CONSECUTIVE_ERRORS", "5"))
+EJECT_ERROR_RATE = float(os.getenv("LB_EJECT_ERROR_RATE", "0.5"))
+EJECT_MIN_REQUESTS = int(os.getenv("LB_EJECT_MIN_REQUESTS", "20"))
+EJECT_WINDOW = float(os.getenv("LB_EJECT_WINDOW", "10"))
+# Doubles with every ejection in a row, up to LB_MAX_EJECTION_TIME
+EJECTION_TIME = float(os.getenv("LB_EJECTION_TIME", "30"))
+MAX_EJECTION_TIME = float(os.getenv("LB_MAX_EJECTION_TIME", "300"))
+MAX_EJECTION_PERCENT = float(os.getenv("LB_MAX_EJECTION_PERCENT", "50"))
+logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
+metrics = MetricsRegistry(METRICS_DIR)
+# /metrics itself is forwarded to the registry, so the balancer's own live under /lb
+instrument_app(app, metrics, path="/lb/metrics")
+upstream_seconds = metrics.histogram(
+    "lb_upstream_request_duration_seconds",
+    "Latency of requests forwarded to registry instances",
+    ["backend", "status"]
+)
+upstream_errors = metrics.counter(
+    "lb_upstream_errors_total",
+    "Forwarded requests that failed without a response",
+    ["backend"]
+)
+upstream_retries = metrics.counter(
+    "lb_upstream_retries_total",
+    "Requests retried on another backend after this one failed",
+    ["backend"]
+)
+ejections = metrics.counter(
+    "lb_backend_ejections_total",
+    "Times a backend was ejected by its circuit breaker",
+    ["backend"]
+)
+upstream_connections = metrics.counter(
+    "lb_upstream_connections_total",
+    "Upstream connection checkouts by outcome (new, reused, expired)",
+    ["backend", "outcome"]
+)
+pools = UpstreamPools(
+    PORT,
+    maxsize=POOL_MAXSIZE,
+    block_timeout=POOL_BLOCK_TIMEOUT,
+    idle_timeout=POOL_IDLE_TIMEOUT,
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT,
+    observe=lambda backend, outcome: upstream_connections.inc(backend, outcome)
+)
+metrics.gauge(
+    "lb_upstream_idle_connections",
+    "Idle keep-alive connections pooled per backend",
+    pools.stats,
+    labels=["backend"]
+)
 client = docker.from_env()
-filters = {
-        'label': [
-            f'com.docker.compose.service=reg-app',
-            f'com.docker.compose.project=registry'
-        ],
-        'status': 'running'
-    }
-target_names = []
+# Running registry containers, followed through Docker events so requests
+# never wait on the Docker API
+discovery = BackendDiscovery(
+    client,
+    labels=[
+        f'com.docker.compose.service=reg-app',
+        f'com.docker.compose.project=registry'
+    ],
+    reconcile_interval=RECONCILE_INTERVAL,
+    on_change=pools.retain,
+    weight_label=WEIGHT_LABEL
+)
+discovery.start()
+stats = SharedStats(STATS_PATH, decay=EWMA_DECAY)
+strategy = create_strategy(STRATEGY, stats, weight=discovery.weight)
+breakers = CircuitBreakers(
+    stats,
+    lambda: discovery.backends,
+    consecutive_errors=EJECT_CONSECUTIVE_ERRORS,
+    error_rate=EJECT_ERROR_RATE,
+    min_requests=EJECT_MIN_REQUESTS,
+    window=EJECT_WINDOW,
+    ejection_time=EJECTION_TIME,
+    max_ejection_time=MAX_EJECTION_TIME,
+    max_ejection_percent=MAX_EJECTION_PERCENT,
+    probe_timeout=CONNECT_TIMEOUT + READ_TIMEOUT,
+    on_eject=lambda backend: ejections.inc(backend)
+)
+metrics.gauge(
+    "lb_backends",
+    "Registry instances currently known to the balancer",
+    lambda: len(discovery.backends),
+    aggregate="max"
+)
+# Both read the shared stats, so every worker reports the same values
+metrics.gauge(
+    "lb_backend_inflight",
+    "Requests in flight per backend across all workers",
+    lambda: {(backend,): stats.inflight(backend) for backend in discovery.backends},
+    labels=["backend"],
+    aggregate="max"
+)
+metrics.gauge(
+    "lb_backend_latency_ewma_seconds",
+    "Peak EWMA of the response latency per backend",
+    lambda: {(backend,): stats.latency(backend) for backend in discovery.backends},
+    labels=["backend"],
+    aggregate="max"
+)
+metrics.gauge(
+    "lb_backend_ejected",
+    "1 while a backend is ejected by its circuit breaker",
+    lambda: {(backend,): int(breakers.ejected(backend)) for backend in discovery.backends},
+    labels=["backend"],
+    aggregate="max"
+)
+# Forces a reconcile with the running containers
 @app.route('/reset')
 def grab_names():
-    containers = client.containers.list(filters=filters)
-    global target_names
-    target_names = []
-    for container in containers:
-        full_name = container.name
-        target_names.append(full_name.lstrip('/'))
-    return jsonify(target_names)
+    return jsonify(list(discovery.reconcile()))
     
+def is_watch(args):
+    return 'index' in args or 'wait' in args
+
+def parse_wait(value):
+    # The registry's duration format: 500ms, 30s, 5m or plain seconds
+    units = (('ms', 0.001), ('s', 1), ('m', 60))
+    for suffix, scale in units:
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * scale
+    return float(value)
+
+def request_read_timeout(args):
+    if not is_watch(args):
+        return READ_TIMEOUT
+    try:
+        wait = parse_wait(args.get('wait', str(WATCH_DEFAULT_WAIT)))
+    except ValueError:
+        # The registry rejects it right away
+        return READ_TIMEOUT
+    return max(READ_TIMEOUT, min(max(wait, 0.0), WATCH_MAX_WAIT) + WATCH_TIMEOUT_MARGIN)
+
 @app.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
 @app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def incoming_request(path):
-    grab_names()
-    global target_names
-    if len(target_names) < 1:
+    if len(discovery.backends) < 1:
         return jsonify("Registry service unavailable"), 503
+    # The pick first, then the others to fail over to, without the
+    # backends that are ejected
+    target_names = breakers.select(strategy.order(discovery.backends))
+    chunked = request.content_length is None and 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+    if chunked or (request.content_length or 0) > RETRY_BODY_MAX:
+        data, replayable = request.stream, False
+    else:
+        data, replayable = request.get_data(), True
+    if request.query_string:
+        path = f"{path}?{request.query_string.decode('latin-1')}"
     try:
         response, target = pass_request(
             method=request.method,
             path=path,
-            headers=request.headers,
-            data=request.get_data()
+            headers=dict(end_to_end(request.headers)),
+            data=data,
+            target_names=target_names,
+            replayable=replayable,
+            chunked=chunked,
+            read_timeout=request_read_timeout(request.args)
         )
-        return (
-            response.content,
-            response.status_code,
-            [(k, v) for k, v in response.headers.items()]
+        if response is None:
+            return jsonify("Registry service unavailable"), 503
+        return app.response_class(
+            StreamedBody(response, STREAM_CHUNK_SIZE, on_close=lambda: stats.finish(target)),
+            status=response.status,
+            headers=end_to_end(response.headers),
+            direct_passthrough=True
         )
     except Exception as e:
         
         return jsonify(f"Error passing request details: {e}"), 503
 
-def pass_request(method, path, headers, data):
-    global target_names
-    if len(target_names) < 1:
-        return jsonify("Registry service unavailable"), 503
-    try:
-        response = requests.request(
-            method=method,
-            url=f"http://{target_names[0]}:{PORT}/{path}",
-            headers=headers,
-            data=data
-        )
-        if 500 <= response.status_code < 600:
-            del target_names[0]
-            return pass_request(method,path,headers,data)
+# Tries the backends in order, at most MAX_RETRIES more after the first.
+# A streamed (not replayable) body can only be sent once, so it gets no
+# failover. Connection errors and 5xx responses count against a backend's
+# circuit breaker; when every attempt failed, the last 5xx is passed back.
+# The backend counts as in flight until its response is closed; watch
+# requests block on purpose, so they are left out of its latency.
+def pass_request(method, path, headers, data, target_names, replayable=True, chunked=False, read_timeout=None):
+    attempts = target_names[:MAX_RETRIES + 1] if replayable else target_names[:1]
+    for attempt, target in enumerate(attempts):
+        last = attempt == len(attempts) - 1
+        start = time.perf_counter()
+        stats.start(target)
+        try:
+            response = pools.request(
+                target,
+                method,
+                f"/{path}",
+                headers=headers,
+                body=data,
+                chunked=chunked,
+                read_timeout=read_timeout
+            )
+        except HTTPError as e:
+            upstream_errors.inc(target)
+            stats.finish(target)
+            breakers.failure(target)
+            if not replayable:
+                raise
+            logging.warning(f"Request to {target} failed: {e}")
+            if not last:
+                upstream_retries.inc(target)
+            continue
+        seconds = time.perf_counter() - start
+        upstream_seconds.observe(seconds, target, str(response.status))
+        if not is_watch(request.args):
+            stats.observe(target, seconds)
+        if 500 <= response.status < 600:
+            breakers.failure(target)
+            if replayable and not last:
+                response.drain_conn()
+                response.release_conn()
+                stats.finish(target)
+                upstream_retries.inc(target)
+                continue
         else:
-            return response, target_names[0]
-        
-    except requests.exceptions.RequestException as e:
-        del target_names[0]
-        return pass_request(method,path,headers,data)
-        
-        
-        
-        
\ No newline at end of file
+            breakers.success(target)
+        return response, target
+    return None, None
@@ -0,0 +1,144 @@
+import threading
+import time
+import logging
+
+from urllib3 import HTTPConnectionPool, Timeout
+
+logger = logging.getLogger(__name__)
+
+# RFC 7230 6.1: meaningful for one connection only, never forwarded
+HOP_BY_HOP = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade'
+))
+
+
+def end_to_end(headers):
+    # Also drops the headers the Connection header names
+    named = {token.strip().lower() for token in headers.get('Connection', '').split(',')}
+    return [(k, v) for k, v in headers.items() if k.lower() not in HOP_BY_HOP and k.lower() not in named]
+
+
+class BackendPool(HTTPConnectionPool):
+    # Keep-alive connections to one backend. Connections idle for longer
+    # than idle_timeout are closed before reuse instead of risking a request
+    # on a socket the backend is about to drop, and every checkout is
+    # reported to observe as "new", "reused" or "expired".
+    def __init__(self, host, port, idle_timeout, observe, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.idle_timeout = idle_timeout
+        self._observe = observe
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        if conn.sock is not None and time.monotonic() - getattr(conn, 'idle_since', 0) > self.idle_timeout:
+            conn.close()
+            self._observe(self.host, 'expired')
+        self._observe(self.host, 'new' if conn.sock is None else 'reused')
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.monotonic()
+        super()._put_conn(conn)
+
+    def idle(self):
+        pool = self.pool
+        if pool is None:
+            return 0
+        return sum(1 for conn in list(pool.queue) if conn is not None and conn.sock is not None)
+
+
+class StreamedBody(object):
+    # WSGI body that relays an upstream response chunk_size bytes at a time,
+    # untouched. The server calls close() when it is done, also when it never
+    # iterated (HEAD, 304) or the client went away; only a connection whose
+    # response was read to the end goes back to the pool for reuse.
+    # on_close runs once the response is done with.
+    def __init__(self, response, chunk_size, on_close=None):
+        self._response = response
+        self._chunk_size = chunk_size
+        self._complete = False
+        self._on_close = on_close or (lambda: None)
+
+    def __iter__(self):
+        for chunk in self._response.stream(self._chunk_size, decode_content=False):
+            yield chunk
+        self._complete = True
+
+    def close(self):
+        try:
+            if not (self._complete or self._response.length_remaining == 0):
+                self._response.close()
+            self._response.release_conn()
+        finally:
+            self._on_close()
+
+
+class UpstreamPools(object):
+    # One BackendPool per backend, created on first use. maxsize caps the
+    # connections to a backend: with block_timeout set a request waits that
+    # long for a free one, otherwise extra connections are opened and closed
+    # after use.
+    def __init__(self, port, maxsize=32, block_timeout=None, idle_timeout=30,
+                 connect_timeout=2, read_timeout=None, observe=None):
+        self.port = port
+        self.maxsize = maxsize
+        self.block_timeout = block_timeout
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.timeout = Timeout(connect=connect_timeout, read=read_timeout)
+        self._observe = observe or (lambda backend, outcome: None)
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def get(self, backend):
+        pool = self._pools.get(backend)
+        if pool is not None:
+            return pool
+        with self._lock:
+            pool = self._pools.get(backend)
+            if pool is None:
+                pool = self._pools[backend] = BackendPool(
+                    backend,
+                    self.port,
+                    idle_timeout=self.idle_timeout,
+                    observe=self._observe,
+                    maxsize=self.maxsize,
+                    block=self.block_timeout is not None,
+                    timeout=self.timeout,
+                    retries=False
+                )
+            return pool
+
+    def retain(self, backends):
+        # Closes the pools of backends that are gone
+        with self._lock:
+            removed = [backend for backend in self._pools if backend not in backends]
+            pools = [self._pools.pop(backend) for backend in removed]
+        for pool in pools:
+            pool.close()
+
+    def request(self, backend, method, path, headers, body, chunked=False, read_timeout=None):
+        # Returns once the response headers are in. body may be bytes or a
+        # file to stream from (chunked when its length is unknown); the
+        # response body is left unread for StreamedBody. read_timeout
+        # overrides the pool's for this request.
+        timeout = self.timeout if read_timeout is None else Timeout(connect=self.connect_timeout, read=read_timeout)
+        return self.get(backend).urlopen(
+            method,
+            path,
+            body=body,
+            headers=headers,
+            redirect=False,
+            assert_same_host=False,
+            timeout=timeout,
+            pool_timeout=self.block_timeout,
+            chunked=chunked,
+            preload_content=False,
+            release_conn=False,
+            decode_content=False
+        )
+
+    def stats(self):
+        return {(backend,): pool.idle() for backend, pool in list(self._pools.items())}
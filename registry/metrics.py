@@ -0,0 +1,323 @@
+import bisect
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds; fits request handling from sub-millisecond cache hits upwards
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, registry, name, help, labels):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def inc(self, *label_values, amount=1):
+        shard = self._registry._shard()
+        key = (self.name, label_values)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labels, buckets):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        shard = self._registry._shard()
+        key = (self.name, label_values)
+        counts = shard.get(key)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+class Gauge(object):
+    # Read from a callback at scrape time, so the hot path never touches it.
+    # The callback returns a number, or a dict of label value tuples to numbers.
+    type = "gauge"
+
+    def __init__(self, registry, name, help, labels, read, aggregate):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+        self.aggregate = aggregate
+
+    def collect(self):
+        value = self.read()
+        if value is None:
+            return {}
+        if isinstance(value, dict):
+            return {tuple(str(label) for label in labels): v for labels, v in value.items()}
+        return {(): value}
+
+
+def merge_sample(series, labels, value):
+    previous = series.get(labels)
+    if previous is None:
+        series[labels] = list(value) if isinstance(value, list) else value
+    elif isinstance(value, list):
+        series[labels] = [a + b for a, b in zip(previous, value)]
+    else:
+        series[labels] = previous + value
+
+
+class ShardOwner(object):
+    # Lives in a thread's thread-local next to its shard; it goes away with
+    # the thread, which is what retires the shard
+    __slots__ = ("__weakref__",)
+
+
+class MetricsRegistry(object):
+    # Prometheus metrics without locks on the hot path: every thread updates
+    # its own shard (a dict no other thread writes) and a scrape merges the
+    # shards. When a thread exits its shard is folded into a retired total,
+    # so servers that start a thread per request do not pile up shards.
+    # With a directory, each process also dumps its totals there
+    # every flush_interval seconds and a scrape merges every process's file,
+    # so any gunicorn worker can answer for all of them.
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory or None
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._reset()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Shards and the flusher thread belong to one process
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._keys = itertools.count()
+        self._flusher = None
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+        shard = {}
+        key = next(self._keys)
+        owner = self._local.owner = ShardOwner()
+        finalizer = weakref.finalize(owner, self._retire, self._shards, key)
+        finalizer.atexit = False
+        with self._lock:
+            self._shards[key] = shard
+            if self.directory and self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+                self._flusher.start()
+        self._local.shard = shard
+        return shard
+
+    def _retire(self, shards, key):
+        # shards is passed in so a finalizer from before a fork leaves the
+        # child's state alone
+        with self._lock:
+            if shards is not self._shards:
+                return
+            shard = shards.pop(key, None)
+            if shard is None:
+                return
+            for (name, labels), value in shard.items():
+                merge_sample(self._retired.setdefault(name, {}), labels, value)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labels, buckets))
+
+    def gauge(self, name, help, read, labels=(), aggregate="sum"):
+        # aggregate is how processes combine: "sum" (pool sizes) or "max"
+        return self._register(Gauge(self, name, help, labels, read, aggregate))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def _collect(self):
+        samples = {}
+        # Taken together, so a shard retired meanwhile is counted once
+        with self._lock:
+            shards = list(self._shards.values())
+            for name, series in self._retired.items():
+                for labels, value in series.items():
+                    merge_sample(samples.setdefault(name, {}), labels, value)
+        for shard in shards:
+            for (name, labels), value in list(shard.items()):
+                merge_sample(samples.setdefault(name, {}), labels, value)
+        for metric in self._metrics.values():
+            if metric.type == "gauge":
+                try:
+                    samples[metric.name] = metric.collect()
+                except Exception as e:
+                    logger.warning(f"Failed to read gauge {metric.name}: {e}")
+        return samples
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def _write(self, samples):
+        path = self._path(self._pid)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "pid": self._pid,
+                "samples": {
+                    name: [[list(labels), value] for labels, value in series.items()]
+                    for name, series in samples.items()
+                }
+            }, f)
+        os.replace(tmp_path, path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self._write(self._collect())
+            except Exception as e:
+                logger.warning(f"Failed to flush metrics: {e}")
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    def clear(self):
+        # Called by a supervisor before it starts its workers
+        if not self.directory:
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json") or filename.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, filename))
+
+    def samples(self):
+        local = self._collect()
+        if not self.directory:
+            return local
+        self._write(local)
+        merged = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # Counters of exited workers still count, their gauges do not
+            alive = data["pid"] == self._pid or self._alive(data["pid"])
+            for name, series in data["samples"].items():
+                metric = self._metrics.get(name)
+                if metric is None or (metric.type == "gauge" and not alive):
+                    continue
+                target = merged.setdefault(name, {})
+                for labels, value in series:
+                    labels = tuple(labels)
+                    previous = target.get(labels)
+                    if previous is None:
+                        target[labels] = value
+                    elif isinstance(value, list):
+                        target[labels] = [a + b for a, b in zip(previous, value)]
+                    elif metric.type == "gauge" and metric.aggregate == "max":
+                        target[labels] = max(previous, value)
+                    else:
+                        target[labels] = previous + value
+        return merged
+
+    def render(self):
+        samples = self.samples()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(samples.get(name, {}).items()):
+                pairs = list(zip(metric.labels, labels))
+                if metric.type == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + ("+Inf",), value):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(pairs + [('le', format_value(bound))])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(pairs)} {format_value(value[-1])}")
+                    lines.append(f"{name}_count{format_labels(pairs)} {cumulative}")
+                else:
+                    lines.append(f"{name}{format_labels(pairs)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    return value if isinstance(value, str) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+
+def instrument_app(app, metrics, path="/metrics"):
+    # Per-route request counts and latency histograms plus a GET endpoint
+    # for the scrape (path).
+    # Routes are labelled by their URL rule, never the raw path, to keep the
+    # number of series bounded.
+    requests_total = metrics.counter(
+        "http_requests_total", "HTTP requests handled", ["method", "route", "status"]
+    )
+    request_seconds = metrics.histogram(
+        "http_request_duration_seconds", "HTTP request latency", ["method", "route"]
+    )
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            request_seconds.observe(time.perf_counter() - start, request.method, route)
+            requests_total.inc(request.method, route, str(response.status_code))
+        return response
+
+    @app.route(path)
+    def get_metrics():
+        return app.response_class(metrics.render(), content_type=CONTENT_TYPE)
+
+    return requests_total, request_seconds
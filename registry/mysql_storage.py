@@ -0,0 +1,181 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector.constants import ClientFlag
+
+from db_pool import ConnectionPool
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# init.sql only runs on an empty data directory, so a database created by
+# an older release is brought up to date before the first query. Every
+# step checks information_schema first and can run again safely
+SCHEMA_TABLES = (
+    """CREATE TABLE IF NOT EXISTS service_tags (
+        service_id CHAR(36) NOT NULL,
+        tag VARCHAR(64) NOT NULL,
+        PRIMARY KEY (service_id, tag),
+        INDEX idx_service_tags_tag (tag, service_id),
+        FOREIGN KEY (service_id) REFERENCES services(id) ON DELETE CASCADE );""",
+    """CREATE TABLE IF NOT EXISTS catalog_state (
+        id TINYINT NOT NULL PRIMARY KEY,
+        revision BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        compacted_revision BIGINT UNSIGNED NOT NULL DEFAULT 0);""",
+    """CREATE TABLE IF NOT EXISTS catalog_changes (
+        id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        revision BIGINT UNSIGNED NOT NULL,
+        op VARCHAR(16) NOT NULL,
+        service_id CHAR(36) NOT NULL,
+        service TEXT,
+        INDEX idx_catalog_changes_revision (revision) );""",
+)
+SCHEMA_COLUMNS = (
+    ("services", "url_hash", "CHAR(64) AS (SHA2(url, 256)) STORED"),
+    ("services", "status", "VARCHAR(16) NOT NULL DEFAULT 'healthy'"),
+    ("services", "weight", "INT UNSIGNED NOT NULL DEFAULT 100"),
+    ("services", "zone", "VARCHAR(64) NULL"),
+    ("services", "version", "VARCHAR(64) NULL"),
+    ("services", "lease_ttl", "INT UNSIGNED NULL"),
+    ("services", "expires_at", "DATETIME(3) NULL"),
+    ("catalog_state", "compacted_revision", "BIGINT UNSIGNED NOT NULL DEFAULT 0"),
+)
+SCHEMA_INDEXES = (
+    ("services", "uq_services_identity", "UNIQUE INDEX uq_services_identity (name, url_hash)"),
+    ("services", "idx_services_resolve", "INDEX idx_services_resolve (name, status, zone)"),
+    ("services", "idx_services_status", "INDEX idx_services_status (status, id)"),
+    ("services", "idx_services_expires_at", "INDEX idx_services_expires_at (expires_at)"),
+)
+# Older releases allowed the same (name, url) twice; all but the row with
+# the lowest id go, with their credentials, before the unique key is added
+DEDUPE_STATEMENTS = (
+    ("credentials", """DELETE u FROM users u
+    JOIN services s ON s.id = u.username
+    JOIN services kept ON kept.name = s.name AND kept.url_hash = s.url_hash AND kept.id < s.id
+    WHERE u.write_access = 'SELF';"""),
+    ("services", """DELETE s FROM services s
+    JOIN services kept ON kept.name = s.name AND kept.url_hash = s.url_hash AND kept.id < s.id;"""),
+)
+MIGRATION_LOCK = "registry_schema_migration"
+MIGRATION_LOCK_TIMEOUT = 60
+
+
+class MySQLStorage(Storage):
+    backend = "mysql"
+    NOW = "UTC_TIMESTAMP(3)"
+    FOR_UPDATE = " FOR UPDATE"
+
+    def __init__(self, pool_size, pool_timeout, pool_validate_after, **connect_args):
+        self.pool = ConnectionPool(
+            size=pool_size,
+            timeout=pool_timeout,
+            validate_after=pool_validate_after,
+            # UPDATE rowcount reports matched rows so lease renewals inside
+            # the same millisecond are not mistaken for missing services
+            client_flags=[ClientFlag.FOUND_ROWS],
+            **connect_args
+        )
+        self._migrated = False
+        self._migrate_lock = threading.Lock()
+
+    def _migrate(self, conn):
+        # Runs once per process, on the first connection the database
+        # accepts, so a registry started before MySQL still migrates.
+        # GET_LOCK keeps replicas from altering the same table at once
+        with self._migrate_lock:
+            if self._migrated:
+                return
+            cursor = conn.cursor(dictionary=True, buffered=True)
+            try:
+                cursor.execute("SELECT GET_LOCK(%s, %s) AS acquired;", [MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT])
+                if not cursor.fetchone()["acquired"]:
+                    raise mysql.connector.Error(msg="Timed out waiting for the schema migration lock")
+                try:
+                    self._apply_schema(cursor)
+                    conn.commit()
+                finally:
+                    cursor.execute("SELECT RELEASE_LOCK(%s);", [MIGRATION_LOCK])
+            finally:
+                cursor.close()
+            self._migrated = True
+
+    def _apply_schema(self, cursor):
+        for statement in SCHEMA_TABLES:
+            cursor.execute(statement)
+        cursor.execute("SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE();")
+        columns = {(row["TABLE_NAME"], row["COLUMN_NAME"]) for row in cursor.fetchall()}
+        for table, column, definition in SCHEMA_COLUMNS:
+            if (table, column) not in columns:
+                logger.info(f"Migrating schema: adding column {table}.{column}")
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+        cursor.execute("SELECT DISTINCT TABLE_NAME, INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE();")
+        indexes = {(row["TABLE_NAME"], row["INDEX_NAME"]) for row in cursor.fetchall()}
+        for table, index, definition in SCHEMA_INDEXES:
+            if (table, index) in indexes:
+                continue
+            if index == "uq_services_identity":
+                for rows, statement in DEDUPE_STATEMENTS:
+                    cursor.execute(statement)
+                    if cursor.rowcount:
+                        logger.warning(f"Migrating schema: removed {cursor.rowcount} duplicate {rows} before adding {index}")
+            logger.info(f"Migrating schema: adding index {table}.{index}")
+            cursor.execute(f"ALTER TABLE {table} ADD {definition};")
+        cursor.execute("INSERT IGNORE INTO catalog_state (id, revision) VALUES (1, 0);")
+
+    @contextmanager
+    def _transaction(self, write=False):
+        try:
+            conn = self.pool.get()
+        except mysql.connector.Error as err:
+            logger.error(f"Database connection error: {err}")
+            raise
+        try:
+            if not self._migrated:
+                self._migrate(conn)
+            # Buffered so a statement can follow a fetchone() on the cursor
+            cursor = conn.cursor(dictionary=True, buffered=True)
+            try:
+                yield cursor
+                if write:
+                    conn.commit()
+            finally:
+                cursor.close()
+        finally:
+            # The pool rolls back whatever was not committed
+            conn.close()
+
+    def now_plus(self, seconds):
+        return f"UTC_TIMESTAMP(3) + INTERVAL {seconds} SECOND"
+
+    def upsert_services(self, cursor, registrations):
+        # url_hash is a stored generated column; expires_at stays NULL for
+        # services without a lease (health-checked)
+        cursor.executemany(f"""
+        INSERT INTO services (id, name, description, url, weight, zone, version, lease_ttl, expires_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, {self.now_plus('%s')})
+        ON DUPLICATE KEY UPDATE
+            description = VALUES(description),
+            weight = VALUES(weight),
+            zone = VALUES(zone),
+            version = VALUES(version),
+            lease_ttl = VALUES(lease_ttl),
+            expires_at = VALUES(expires_at),
+            status = 'healthy';
+        """, [
+            (reg['id'], reg['name'], reg['description'], reg['url'], reg['weight'], reg['zone'], reg['version'], reg['ttl'], reg['ttl'])
+            for reg in registrations
+        ])
+
+    def upsert_users(self, cursor, credentials):
+        cursor.executemany("""
+        INSERT INTO users (username, password_hash, write_access)
+        VALUES (%s, %s, 'SELF')
+        ON DUPLICATE KEY UPDATE password_hash = VALUES(password_hash);
+        """, credentials)
+
+    def stats(self):
+        stats = self.pool.stats()
+        stats["backend"] = self.backend
+        return stats
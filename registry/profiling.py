@@ -0,0 +1,297 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timezone
+
+from flask import g, jsonify, request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_ID = re.compile(r"^[0-9]+-[0-9]+$")
+
+
+class RequestTrace(object):
+    def __init__(self, thread_id, method, path, reason):
+        self.thread_id = thread_id
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.id = None
+        # Only the sampler thread writes stacks, only the request thread spans
+        self.stacks = collections.Counter()
+        self.spans = []
+
+
+class Profiler(object):
+    # Opt-in request profiling without touching the request thread.
+    # A request is profiled when it is picked by sample_rate or carries the
+    # debug header with the right token. One sampler thread snapshots the
+    # stack of every profiled request each interval seconds (a statistical
+    # profiler, so the cost stays off the request path). Every other request
+    # is only watched: once it has run for half of slow_threshold its stack
+    # is sampled too, so a slow request is captured with where its time went.
+    # Watch requests (any of watch_args in the query) block by design, so
+    # they are neither sampled nor captured as slow, only on the debug header.
+    # Captures go to a ring buffer of buffer_size entries; with a directory
+    # each process also writes them there so any worker can serve them all.
+    def __init__(self, sample_rate=0.0, slow_threshold=0.0, header="X-Debug-Profile", token=None,
+                 interval=0.005, buffer_size=100, directory=None, max_depth=64, watch_args=("index", "wait")):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.header = header
+        self.token = token or None
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.directory = directory or None
+        self.max_depth = max_depth
+        self.watch_args = tuple(watch_args)
+        self.enabled = bool(sample_rate > 0 or slow_threshold > 0 or self.token)
+        self._local = threading.local()
+        self._reset()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._active = {}
+        self._buffer = collections.deque(maxlen=self.buffer_size)
+        self._ids = itertools.count(1)
+        self._sampler = None
+
+    def _reason(self, watch):
+        if self.token and request.headers.get(self.header) == self.token:
+            return "header"
+        if watch:
+            return None
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def start(self):
+        if not self.enabled:
+            return None
+        watch = any(arg in request.args for arg in self.watch_args)
+        reason = self._reason(watch)
+        if reason is None and (watch or self.slow_threshold <= 0):
+            return None
+        if self._sampler is None:
+            with self._lock:
+                if self._sampler is None:
+                    self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                    self._sampler.start()
+        trace = RequestTrace(threading.get_ident(), request.method, request.path, reason)
+        if reason is not None:
+            trace.id = self._next_id()
+        self._local.trace = trace
+        self._active[trace.thread_id] = trace
+        return trace
+
+    def finish(self, trace, route, status):
+        self._active.pop(trace.thread_id, None)
+        self._local.trace = None
+        duration = time.perf_counter() - trace.start
+        slow = self.slow_threshold > 0 and duration >= self.slow_threshold
+        if trace.reason is None and not slow:
+            return None
+        if trace.id is None:
+            trace.id = self._next_id()
+        entry = self._entry(trace, route, status, duration, slow)
+        self._buffer.append(entry)
+        if self.directory:
+            try:
+                self._write(entry)
+            except OSError as e:
+                logger.warning(f"Failed to save profile {trace.id}: {e}")
+        if slow:
+            logger.warning(f"Slow request {trace.method} {trace.path} took {duration * 1000:.0f}ms (profile {trace.id})")
+        return entry
+
+    def _next_id(self):
+        return f"{self._pid}-{next(self._ids)}"
+
+    def record(self, name, seconds):
+        # Adds a timed step (a DB query, bcrypt, an upstream call) to the
+        # breakdown of the request running on this thread, if it is traced
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            trace.spans.append((name, seconds))
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def _sample_loop(self):
+        watch_after = self.slow_threshold / 2
+        while True:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            now = time.perf_counter()
+            frames = sys._current_frames()
+            for thread_id, trace in list(self._active.items()):
+                if trace.reason is None and now - trace.start < watch_after:
+                    continue
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    trace.stacks[self._stack(frame)] += 1
+            del frames
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            filename = "/".join(code.co_filename.replace("\\", "/").split("/")[-2:])
+            stack.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _entry(self, trace, route, status, duration, slow):
+        spans = {}
+        for name, seconds in trace.spans:
+            total = spans.setdefault(name, {"name": name, "count": 0, "duration_ms": 0.0})
+            total["count"] += 1
+            total["duration_ms"] += seconds * 1000
+        samples = sum(trace.stacks.values())
+        return {
+            "id": trace.id,
+            "time": datetime.fromtimestamp(trace.started_at, tz=timezone.utc).isoformat(),
+            "method": trace.method,
+            "path": trace.path,
+            "route": route,
+            "status": status,
+            "duration_ms": round(duration * 1000, 3),
+            "reason": trace.reason or "slow",
+            "slow": slow,
+            "spans": sorted(spans.values(), key=lambda span: -span["duration_ms"]),
+            "interval_ms": self.interval * 1000,
+            "samples": samples,
+            "stacks": [{"stack": stack, "samples": count} for stack, count in trace.stacks.most_common()],
+        }
+
+    def _write(self, entry):
+        seq = int(entry["id"].rsplit("-", 1)[1])
+        path = os.path.join(self.directory, f"{entry['id']}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(f"{path}.tmp", path)
+        # Keep the directory bounded like the in-memory buffer
+        expired = os.path.join(self.directory, f"{self._pid}-{seq - self.buffer_size}.json")
+        if seq > self.buffer_size and os.path.exists(expired):
+            os.remove(expired)
+
+    def clear(self):
+        # Called by a supervisor before it starts its workers
+        self._buffer.clear()
+        if not self.directory:
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json") or filename.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, filename))
+
+    def profiles(self):
+        if not self.directory:
+            entries = list(self._buffer)
+        else:
+            entries = []
+            for filename in os.listdir(self.directory):
+                if not filename.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        entries.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return sorted(entries, key=lambda entry: entry["time"], reverse=True)
+
+    def profile(self, profile_id):
+        if not PROFILE_ID.match(profile_id):
+            return None
+        if not self.directory:
+            return next((entry for entry in self._buffer if entry["id"] == profile_id), None)
+        try:
+            with open(os.path.join(self.directory, f"{profile_id}.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+def collapsed(entry):
+    # Brendan Gregg's folded format, readable by flamegraph.pl and speedscope
+    return "".join(f"{stack['stack']} {stack['samples']}\n" for stack in entry["stacks"])
+
+
+def token_guard(token):
+    # For apps without users: the endpoints take the token as a bearer token
+    # and do not exist while no token is configured
+    def guard(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not token:
+                return jsonify({"message": "Profiling is not enabled"}), 404
+            if request.headers.get("Authorization") != f"Bearer {token}":
+                return jsonify({"message": "Invalid token"}), 401
+            return f(*args, **kwargs)
+        return decorated
+    return guard
+
+
+def install_profiler(app, profiler, guard):
+    # Request hooks plus the admin download endpoints, protected by guard
+    @app.before_request
+    def start_profile():
+        trace = profiler.start()
+        if trace is not None:
+            g.profile_trace = trace
+
+    @app.after_request
+    def tag_profile(response):
+        trace = g.get("profile_trace")
+        if trace is not None:
+            g.profile_status = response.status_code
+            if trace.reason == "header":
+                response.headers[PROFILE_ID_HEADER] = trace.id
+        return response
+
+    @app.teardown_request
+    def finish_profile(exc):
+        trace = g.pop("profile_trace", None)
+        if trace is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            profiler.finish(trace, route, g.pop("profile_status", 500))
+
+    # GET Endpoint to download every captured profile
+    @app.route("/admin/profiles")
+    @guard
+    def get_profiles():
+        response = jsonify({"profiles": profiler.profiles()})
+        response.headers["Content-Disposition"] = "attachment; filename=profiles.json"
+        return response
+
+    # GET Endpoint for a single profile, as JSON or folded stacks (?format=collapsed)
+    @app.route("/admin/profiles/<profile_id>")
+    @guard
+    def get_profile(profile_id):
+        entry = profiler.profile(profile_id)
+        if entry is None:
+            return jsonify({"message": f"Profile {profile_id} not found"}), 404
+        if request.args.get("format") == "collapsed":
+            return app.response_class(collapsed(entry), content_type="text/plain; charset=utf-8")
+        return jsonify(entry)
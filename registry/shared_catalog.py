@@ -0,0 +1,132 @@
+import os
+import mmap
+import fcntl
+import struct
+import time
+import logging
+from contextlib import contextmanager
+
+from catalog_cache import CatalogSnapshot
+
+logger = logging.getLogger(__name__)
+
+# The header starts with a sequence counter, then the published generation,
+# its catalog revision, when the database was last checked and the body size
+SEQUENCE = struct.Struct("<Q")
+FIELDS = struct.Struct("<QQdQ")
+HEADER_SIZE = SEQUENCE.size + FIELDS.size
+READ_ATTEMPTS = 1000
+
+
+class MappedSnapshot(CatalogSnapshot):
+    # body is a read-only mapping of the published file, shared by every
+    # process that maps it
+    def __init__(self, revision, body, path):
+        super().__init__(revision, None, body)
+        self.path = path
+
+    def open(self):
+        # Older generations are removed once two newer ones exist, so a
+        # request may occasionally have to fall back to the mapping
+        try:
+            return open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+
+
+class SharedCatalog(object):
+    # The serialized catalog in shared memory for all gunicorn processes.
+    # Every publish writes the body once to its own file in directory (tmpfs
+    # by default) and every process maps that same file, so memory stays flat
+    # as workers are added and responses go out with sendfile straight from
+    # the page cache. A small mapped header names the current file; readers
+    # check it on every lookup, so all processes switch to a new revision the
+    # moment it is published. The header is a seqlock: the writer makes the
+    # sequence odd while it updates the fields, and readers retry until they
+    # see the same even sequence before and after reading them. Writers take
+    # an flock, so one process at a time refreshes from the database.
+    def __init__(self, directory, keep=2):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(os.path.join(directory, "header"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < HEADER_SIZE:
+                os.ftruncate(fd, HEADER_SIZE)
+            self._header = mmap.mmap(fd, HEADER_SIZE)
+        finally:
+            os.close(fd)
+        self._lock_path = os.path.join(directory, "lock")
+
+    def _path(self, generation):
+        return os.path.join(self.directory, f"{generation}.json")
+
+    def read_header(self):
+        # Returns (generation, revision, checked_at, length), generation 0
+        # before the first publish, or None if a writer died mid-update
+        for _ in range(READ_ATTEMPTS):
+            sequence = SEQUENCE.unpack_from(self._header)[0]
+            if sequence % 2 == 0:
+                fields = FIELDS.unpack_from(self._header, SEQUENCE.size)
+                if SEQUENCE.unpack_from(self._header)[0] == sequence:
+                    return fields
+            time.sleep(0)
+        return None
+
+    def _write_header(self, generation, revision, checked_at, length):
+        sequence = SEQUENCE.unpack_from(self._header)[0]
+        # An odd sequence here means a writer died mid-update; the flock
+        # makes this process the only writer, so it simply takes over
+        sequence += 1 if sequence % 2 == 0 else 0
+        SEQUENCE.pack_into(self._header, 0, sequence)
+        FIELDS.pack_into(self._header, SEQUENCE.size, generation, revision, checked_at, length)
+        SEQUENCE.pack_into(self._header, 0, sequence + 1)
+
+    @contextmanager
+    def lock(self):
+        # A fresh open file per call: flocks belong to the open file, which
+        # a forked worker would otherwise share with its parent
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def snapshot(self, generation, revision):
+        path = self._path(generation)
+        with open(path, "rb") as f:
+            body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedSnapshot(revision, body, path)
+
+    def publish(self, revision, body, checked_at):
+        # Callers hold lock()
+        header = self.read_header()
+        generation = (header[0] if header else 0) + 1
+        path = self._path(generation)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(body)
+        os.replace(f"{path}.tmp", path)
+        self._write_header(generation, revision, checked_at, len(body))
+        self._remove_old(generation)
+        return generation
+
+    def touch(self, checked_at):
+        # Callers hold lock(); records a revalidation that found no change
+        header = self.read_header()
+        if header and header[0]:
+            generation, revision, _, length = header
+            self._write_header(generation, revision, checked_at, length)
+
+    def expire(self):
+        # After a local write: every process refreshes on its next lookup,
+        # so a write is visible through all workers, not only the one that
+        # made it
+        with self.lock():
+            self.touch(0.0)
+
+    def _remove_old(self, generation):
+        for filename in os.listdir(self.directory):
+            stem, _, extension = filename.partition(".")
+            if extension == "json" and stem.isdigit() and int(stem) <= generation - self.keep:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+
+from storage import Storage, url_hash
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init_sqlite.sql")
+
+
+def dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor(object):
+    # Lets the shared queries keep MySQL style %s placeholders
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(sql.replace("%s", "?"), params)
+
+    def executemany(self, sql, rows):
+        self._cursor.executemany(sql.replace("%s", "?"), rows)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+class SQLiteStorage(Storage):
+    # Embedded single-node storage. The database runs in WAL mode so readers
+    # never block the writer or each other; every thread gets its own
+    # connection and writes take the lock up front with BEGIN IMMEDIATE.
+    backend = "sqlite"
+    NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+    LIKE_ESCAPE = " ESCAPE '\\'"
+
+    def __init__(self, path, busy_timeout=5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._pid = os.getpid()
+        conn = self._connect()
+        try:
+            with open(SCHEMA_PATH) as f:
+                conn.executescript(f.read())
+            self.journal_mode = conn.execute("PRAGMA journal_mode = WAL;").fetchone()["journal_mode"]
+        finally:
+            conn.close()
+        logger.info(f"Opened SQLite storage {path} (journal_mode={self.journal_mode})")
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        conn.row_factory = dict_row
+        conn.execute("PRAGMA foreign_keys = ON;")
+        # WAL is durable against crashes with NORMAL; only a power loss can
+        # roll back the last transactions
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        with self._lock:
+            self._opened += 1
+        return conn
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # Connections must never cross a fork
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._local = threading.local()
+                    self._opened = 0
+                    self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def _transaction(self, write=False):
+        conn = self._connection()
+        # A read transaction pins one WAL snapshot for all its statements
+        conn.execute("BEGIN IMMEDIATE;" if write else "BEGIN;")
+        try:
+            yield SQLiteCursor(conn.cursor())
+            conn.execute("COMMIT;")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+
+    def now_plus(self, seconds):
+        return f"strftime('%Y-%m-%d %H:%M:%f', 'now', '+' || ({seconds}) || ' seconds')"
+
+    def upsert_services(self, cursor, registrations):
+        # SQLite has no SHA2(), so url_hash is computed here
+        cursor.executemany(f"""
+        INSERT INTO services (id, name, description, url, url_hash, weight, zone, version, lease_ttl, expires_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, {self.now_plus('%s')})
+        ON CONFLICT (name, url_hash) DO UPDATE SET
+            description = excluded.description,
+            weight = excluded.weight,
+            zone = excluded.zone,
+            version = excluded.version,
+            lease_ttl = excluded.lease_ttl,
+            expires_at = excluded.expires_at,
+            status = 'healthy';
+        """, [
+            (reg['id'], reg['name'], reg['description'], reg['url'], url_hash(reg['url']), reg['weight'], reg['zone'], reg['version'], reg['ttl'], reg['ttl'])
+            for reg in registrations
+        ])
+
+    def upsert_users(self, cursor, credentials):
+        cursor.executemany("""
+        INSERT INTO users (username, password_hash, write_access)
+        VALUES (%s, %s, 'SELF')
+        ON CONFLICT (username) DO UPDATE SET password_hash = excluded.password_hash;
+        """, credentials)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "path": self.path,
+                "journal_mode": self.journal_mode,
+                "connections": self._opened,
+            }
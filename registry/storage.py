@@ -0,0 +1,378 @@
+import hashlib
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Compound SELECTs per statement; SQLite allows at most 500 terms
+LOOKUP_CHUNK = 250
+
+
+def url_hash(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest() if url is not None else None
+
+
+class Storage(ABC):
+    # Every query the registry runs, written once against a small dialect:
+    # backends provide _transaction() (a dictionary cursor inside one
+    # transaction, %s placeholders) plus the few statements that differ.
+    backend = None
+    # Called with (operation, seconds) after every transaction
+    observe = None
+    # Current UTC time with millisecond precision
+    NOW = None
+    # Appended to SELECTs that must lock the rows they read
+    FOR_UPDATE = ""
+    # Appended to LIKE so a backslash escapes % and _
+    LIKE_ESCAPE = ""
+
+    @contextmanager
+    def transaction(self, operation, write=False):
+        start = time.perf_counter()
+        try:
+            with self._transaction(write) as cursor:
+                yield cursor
+        finally:
+            if self.observe is not None:
+                self.observe(operation, time.perf_counter() - start)
+
+    @abstractmethod
+    def _transaction(self, write=False):
+        pass
+
+    @abstractmethod
+    def now_plus(self, seconds):
+        # SQL expression for NOW plus an SQL expression of seconds; NULL
+        # seconds must give NULL
+        pass
+
+    @abstractmethod
+    def upsert_services(self, cursor, registrations):
+        pass
+
+    @abstractmethod
+    def upsert_users(self, cursor, credentials):
+        pass
+
+    def stats(self):
+        return {"backend": self.backend}
+
+    def close(self):
+        pass
+
+    # Users
+
+    def get_user(self, username):
+        with self.transaction("get_user") as cursor:
+            cursor.execute(
+                "SELECT username, password_hash, write_access FROM users WHERE username = %s;",
+                [username]
+            )
+            return cursor.fetchone()
+
+    def compact_orphaned_users(self):
+        # Service credentials whose service row is gone (crashed instances
+        # that never deregistered, rows removed before upserts existed)
+        with self.transaction("compact_orphaned_users", write=True) as cursor:
+            cursor.execute(
+                "DELETE FROM users WHERE write_access = 'SELF' "
+                "AND NOT EXISTS (SELECT 1 FROM services WHERE services.id = users.username);"
+            )
+            return cursor.rowcount
+
+    # Catalog reads
+
+    def fetch_probe_targets(self):
+        # Leased services prove liveness with heartbeats and are never probed
+        with self.transaction("fetch_probe_targets") as cursor:
+            cursor.execute("SELECT id, url, status FROM services WHERE expires_at IS NULL;")
+            return cursor.fetchall()
+
+    def fetch_catalog_revision(self):
+        with self.transaction("fetch_catalog_revision") as cursor:
+            cursor.execute("SELECT revision FROM catalog_state WHERE id = 1;")
+            row = cursor.fetchone()
+            return row["revision"] if row else 0
+
+    def fetch_catalog(self):
+        # All reads share one transaction so the revision matches the rows
+        with self.transaction("fetch_catalog") as cursor:
+            cursor.execute("SELECT revision FROM catalog_state WHERE id = 1;")
+            row = cursor.fetchone()
+            cursor.execute("SELECT id, name, description, url, status, weight, zone, version FROM services;")
+            services = cursor.fetchall()
+            cursor.execute("SELECT service_id, tag FROM service_tags ORDER BY service_id, tag;")
+            tags = {}
+            for tag_row in cursor.fetchall():
+                tags.setdefault(tag_row["service_id"], []).append(tag_row["tag"])
+        for service in services:
+            service["tags"] = tags.get(service["id"], [])
+        return (row["revision"] if row else 0), services
+
+    def _attach_tags(self, cursor, rows):
+        if not rows:
+            return
+        placeholders = ", ".join(["%s"] * len(rows))
+        cursor.execute(
+            f"SELECT service_id, tag FROM service_tags WHERE service_id IN ({placeholders}) ORDER BY tag;",
+            [row["id"] for row in rows]
+        )
+        tags = {}
+        for tag_row in cursor.fetchall():
+            tags.setdefault(tag_row["service_id"], []).append(tag_row["tag"])
+        for row in rows:
+            row["tags"] = tags.get(row["id"], [])
+
+    def query_services(self, columns, name=None, prefix=None, statuses=None, after=None, limit=None, tags=False):
+        # Returns (rows, id of the last row when another page exists). Every
+        # filter maps onto an index: name/prefix on idx_services_resolve,
+        # status on idx_services_status and the id cursor on the primary key
+        clauses = []
+        params = []
+        if name is not None:
+            clauses.append("name = %s")
+            params.append(name)
+        if prefix is not None:
+            escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            clauses.append("name LIKE %s" + self.LIKE_ESCAPE)
+            params.append(escaped + "%")
+        if statuses:
+            clauses.append(f"status IN ({', '.join(['%s'] * len(statuses))})")
+            params.extend(statuses)
+        if after is not None:
+            clauses.append("id > %s")
+            params.append(after)
+        sql = f"SELECT {', '.join(['id'] + [column for column in columns if column != 'id'])} FROM services"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id"
+        if limit is not None:
+            # One extra row tells us whether another page exists
+            sql += " LIMIT %s"
+            params.append(limit + 1)
+        with self.transaction("query_services") as cursor:
+            cursor.execute(sql + ";", params)
+            rows = cursor.fetchall()
+            next_after = None
+            if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                next_after = rows[-1]["id"]
+            if tags:
+                self._attach_tags(cursor, rows)
+        return rows, next_after
+
+    def resolve_instances(self, name, zone=None, version=None, tags=()):
+        # Served by idx_services_resolve (name, status, zone); leases that
+        # have lapsed but were not swept yet are skipped as well
+        sql = f"""
+        SELECT id, url, weight, zone, version FROM services
+        WHERE name = %s AND status = 'healthy'
+        AND (expires_at IS NULL OR expires_at >= {self.NOW})
+        """
+        params = [name]
+        if zone is not None:
+            sql += " AND zone = %s"
+            params.append(zone)
+        if version is not None:
+            sql += " AND version = %s"
+            params.append(version)
+        for tag in tags:
+            sql += " AND id IN (SELECT service_id FROM service_tags WHERE tag = %s)"
+            params.append(tag)
+        with self.transaction("resolve_instances") as cursor:
+            cursor.execute(sql + " ORDER BY id;", params)
+            instances = cursor.fetchall()
+            self._attach_tags(cursor, instances)
+        return instances
+
+    # Change log
+
+    def _record_changes(self, cursor, changes):
+        # Bumps the catalog revision and appends (op, service_id, service)
+        # rows to the change log under it, inside the caller's transaction
+        cursor.execute("UPDATE catalog_state SET revision = revision + 1 WHERE id = 1;")
+        cursor.execute("SELECT revision FROM catalog_state WHERE id = 1;")
+        revision = cursor.fetchone()["revision"]
+        cursor.executemany(
+            "INSERT INTO catalog_changes (revision, op, service_id, service) VALUES (%s, %s, %s, %s);",
+            [
+                (revision, op, service_id, json.dumps(service) if service is not None else None)
+                for op, service_id, service in changes
+            ]
+        )
+        return revision
+
+    def fetch_changes(self, since, limit):
+        # Returns (revision, None) when since is outside the change log,
+        # otherwise (revision, (upper, changes))
+        with self.transaction("fetch_changes") as cursor:
+            cursor.execute("SELECT revision, compacted_revision FROM catalog_state WHERE id = 1;")
+            state = cursor.fetchone()
+            revision = state["revision"]
+            if since < state["compacted_revision"] or since > revision:
+                return revision, None
+            # Revisions are dense, so paging by revision range never splits
+            # the changes of one transaction across pages
+            upper = min(revision, since + limit)
+            cursor.execute(
+                "SELECT revision, op, service_id, service FROM catalog_changes WHERE revision > %s AND revision <= %s ORDER BY revision, id;",
+                [since, upper]
+            )
+            rows = cursor.fetchall()
+        changes = []
+        for row in rows:
+            change = {"revision": row["revision"], "op": row["op"], "id": row["service_id"]}
+            if row["service"] is not None:
+                change["service"] = json.loads(row["service"])
+            changes.append(change)
+        return revision, (upper, changes)
+
+    def compact_change_log(self, retention):
+        # Returns (entries removed, compacted revision)
+        with self.transaction("compact_change_log", write=True) as cursor:
+            cursor.execute(
+                "SELECT revision, compacted_revision FROM catalog_state WHERE id = 1" + self.FOR_UPDATE + ";"
+            )
+            state = cursor.fetchone()
+            compacted = max(state["compacted_revision"], state["revision"] - retention, 0)
+            cursor.execute("UPDATE catalog_state SET compacted_revision = %s WHERE id = 1;", [compacted])
+            cursor.execute("DELETE FROM catalog_changes WHERE revision <= %s;", [compacted])
+            return cursor.rowcount, compacted
+
+    # Writes
+
+    def _stored_ids(self, cursor, registrations):
+        # The id of each registration's row. Every branch compares the name
+        # column itself with a parameter, so the match follows the column's
+        # collation (case- and, on MySQL, accent-insensitive) exactly as the
+        # upsert did; folding names in Python would not
+        ids = {}
+        for start in range(0, len(registrations), LOOKUP_CHUNK):
+            chunk = registrations[start:start + LOOKUP_CHUNK]
+            cursor.execute(
+                " UNION ALL ".join(["SELECT %s AS item, id FROM services WHERE name = %s AND url_hash = %s"] * len(chunk)) + ";",
+                [value for item, reg in enumerate(chunk, start) for value in (item, reg["name"], url_hash(reg["url"]))]
+            )
+            ids.update((row["item"], row["id"]) for row in cursor.fetchall())
+        return [ids[item] for item in range(len(registrations))]
+
+    def _stored_services(self, cursor, service_ids):
+        # The rows as the upsert left them, which keep their stored name when
+        # a registration matched it only under the collation
+        services = []
+        for start in range(0, len(service_ids), LOOKUP_CHUNK):
+            chunk = service_ids[start:start + LOOKUP_CHUNK]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(
+                f"SELECT id, name, description, url, status, weight, zone, version FROM services WHERE id IN ({placeholders}) ORDER BY id;",
+                chunk
+            )
+            rows = cursor.fetchall()
+            self._attach_tags(cursor, rows)
+            services.extend(rows)
+        return services
+
+    def register_services(self, registrations, password_hashes):
+        # Registration is idempotent on (name, url): a restarting instance
+        # gets its existing row (and id) back with refreshed fields and
+        # credentials instead of leaving a duplicate behind. Fills in
+        # reg['id'] with the stored id; registrations that land on the same
+        # row share it, and the last one's credentials and tags win, as its
+        # fields did in the upsert
+        with self.transaction("register_services", write=True) as cursor:
+            self.upsert_services(cursor, registrations)
+            for reg, service_id in zip(registrations, self._stored_ids(cursor, registrations)):
+                reg["id"] = service_id
+            latest = {reg["id"]: (reg, password_hash) for reg, password_hash in zip(registrations, password_hashes)}
+            self.upsert_users(cursor, [
+                (service_id, password_hash) for service_id, (reg, password_hash) in latest.items()
+            ])
+            placeholders = ", ".join(["%s"] * len(latest))
+            cursor.execute(
+                f"DELETE FROM service_tags WHERE service_id IN ({placeholders});",
+                list(latest)
+            )
+            tag_rows = [(reg["id"], tag) for reg, _ in latest.values() for tag in reg["tags"]]
+            if tag_rows:
+                cursor.executemany("INSERT INTO service_tags (service_id, tag) VALUES (%s, %s);", tag_rows)
+            self._record_changes(cursor, [
+                ("register", service["id"], service) for service in self._stored_services(cursor, list(latest))
+            ])
+
+    def remove_service(self, service_id, reason):
+        return service_id in self.remove_services([service_id], reason)
+
+    def remove_services(self, service_ids, reason):
+        # Set-based variant: one locking read and one DELETE per table for
+        # the whole batch. Returns the ids that actually existed
+        placeholders = ", ".join(["%s"] * len(service_ids))
+        with self.transaction("remove_services", write=True) as cursor:
+            cursor.execute(
+                f"SELECT id FROM services WHERE id IN ({placeholders})" + self.FOR_UPDATE + ";",
+                list(service_ids)
+            )
+            removed = [row["id"] for row in cursor.fetchall()]
+            if removed:
+                placeholders = ", ".join(["%s"] * len(removed))
+                cursor.execute(f"DELETE FROM services WHERE id IN ({placeholders});", removed)
+                cursor.execute(f"DELETE FROM users WHERE username IN ({placeholders});", removed)
+                self._record_changes(cursor, [(reason, service_id, None) for service_id in removed])
+        return set(removed)
+
+    def update_statuses(self, status_changes):
+        # status_changes maps a status to the ids that moved into it
+        with self.transaction("update_statuses", write=True) as cursor:
+            for status, service_ids in status_changes.items():
+                placeholders = ", ".join(["%s"] * len(service_ids))
+                cursor.execute(
+                    f"UPDATE services SET status = %s WHERE id IN ({placeholders});",
+                    [status, *service_ids]
+                )
+            self._record_changes(cursor, [
+                ("status", service_id, {"id": service_id, "status": status})
+                for status, service_ids in status_changes.items()
+                for service_id in service_ids
+            ])
+
+    def renew_lease(self, service_id):
+        with self.transaction("renew_lease", write=True) as cursor:
+            cursor.execute(
+                f"UPDATE services SET expires_at = {self.now_plus('lease_ttl')} "
+                f"WHERE id = %s AND expires_at >= {self.NOW};",
+                [service_id]
+            )
+            return cursor.rowcount > 0
+
+    def expire_leases(self):
+        # Range deletes over the expires_at index remove every lapsed lease
+        # together with its credentials. The ids are locked first, against a
+        # fixed cutoff, so the change log matches exactly what gets deleted
+        with self.transaction("expire_leases", write=True) as cursor:
+            cursor.execute(f"SELECT {self.NOW} AS cutoff;")
+            cutoff = cursor.fetchone()["cutoff"]
+            cursor.execute(
+                "SELECT id FROM services WHERE expires_at < %s" + self.FOR_UPDATE + ";", [cutoff]
+            )
+            expired_ids = [row["id"] for row in cursor.fetchall()]
+            if expired_ids:
+                cursor.execute(
+                    "DELETE FROM users WHERE username IN (SELECT id FROM services WHERE expires_at < %s);",
+                    [cutoff]
+                )
+                cursor.execute("DELETE FROM services WHERE expires_at < %s;", [cutoff])
+                self._record_changes(cursor, [("expire", service_id, None) for service_id in expired_ids])
+        return expired_ids
+
+
+def create_storage(backend, **options):
+    # Backends are imported lazily so only the selected one gets loaded
+    if backend == "mysql":
+        from mysql_storage import MySQLStorage
+        return MySQLStorage(**options)
+    if backend == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(**options)
+    raise ValueError(f"Unknown storage backend '{backend}', expected mysql or sqlite")
@@ -0,0 +1,28 @@
+from failure_detector import HEALTHY, SUSPECT, UNHEALTHY, FailureDetector
+
+
+def detector():
+    return FailureDetector(suspect_after=1, unhealthy_after=3, evict_after=6, recover_after=2)
+
+
+def test_failures_move_a_service_down_to_eviction():
+    fd = detector()
+    seen = [fd.observe("a", False) for _ in range(6)]
+    assert [status for status, _ in seen] == [SUSPECT, SUSPECT, UNHEALTHY, UNHEALTHY, UNHEALTHY, UNHEALTHY]
+    assert [evict for _, evict in seen] == [False] * 5 + [True]
+
+
+def test_a_single_success_does_not_lift_an_unhealthy_service_to_suspect():
+    fd = detector()
+    for _ in range(3):
+        fd.observe("a", False)
+    assert fd.observe("a", True) == (UNHEALTHY, False)
+    assert fd.observe("a", False) == (UNHEALTHY, False)
+
+
+def test_unhealthy_service_recovers_after_enough_successes():
+    fd = detector()
+    fd.observe("a", False, known_status=UNHEALTHY)
+    fd.observe("a", True)
+    assert fd.observe("a", True) == (HEALTHY, False)
+    assert fd.observe("a", False) == (SUSPECT, False)
@@ -0,0 +1,43 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from health_checker import HealthChecker, percentile
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) == 0.0
+
+
+def test_stats_list_a_bounded_number_of_probes():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        up = [{"id": f"up{i}", "url": f"http://127.0.0.1:{server.server_port}/"} for i in range(30)]
+        # Nothing listens on port 1, so these fail at once
+        down = [{"id": f"down{i}", "url": "http://127.0.0.1:1/"} for i in range(30)]
+        checker = HealthChecker(concurrency=8, connect_timeout=1, read_timeout=1, report_size=5)
+        checker.sweep(up + down)
+    finally:
+        server.shutdown()
+    stats = checker.stats()
+    assert (stats["probed"], stats["failed"]) == (60, 30)
+    assert "probes" not in stats
+    assert len(stats["failed_probes"]) == 5
+    assert all(not probe["ok"] for probe in stats["failed_probes"])
+    assert len(stats["slowest_probes"]) == 5
+    assert stats["slowest_probes"][0]["latency"] == stats["latency_max"]
+    assert stats["latency_p50"] <= stats["latency_p99"] <= stats["latency_max"]
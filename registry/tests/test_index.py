@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    # index configures itself from the environment at import time
+    workdir = tmp_path_factory.mktemp("registry")
+    os.environ.update(
+        STORAGE_BACKEND="sqlite",
+        LEADER_ELECTION="file",
+        SQLITE_PATH=str(workdir / "registry.db"),
+        LEADER_LOCK_FILE=str(workdir / "leader.lock"),
+        HEALTH_STATS_PATH=str(workdir / "health_stats.json"),
+        CATALOG_SHARED_DIR=str(workdir / "shared_catalog"),
+        CATALOG_SNAPSHOT_PATH=str(workdir / "catalog.snapshot"),
+        METRICS_DIR=str(workdir / "metrics"),
+        PROFILE_DIR=str(workdir / "profiles"),
+        HEALTH_CHECK_INTERVAL="86400",
+    )
+    import index
+    yield index
+    index.scheduler.shutdown(wait=False)
+
+
+def test_services_falls_back_to_bytes_when_the_generation_file_is_gone(index, monkeypatch):
+    from shared_catalog import MappedSnapshot
+    from werkzeug.test import EnvironBuilder
+
+    open_file = MappedSnapshot.open
+
+    def removed_first(snapshot):
+        # A newer publish removed this generation after the lookup
+        os.remove(snapshot.path)
+        return open_file(snapshot)
+
+    monkeypatch.setattr(MappedSnapshot, "open", removed_first)
+    expected = index.catalog.get().body
+    environ = EnvironBuilder(path="/services").get_environ()
+    statuses = []
+    # The raw iterable is what gunicorn writes out; the test client would
+    # join the chunks and hide a chunk that is not bytes
+    chunks = list(index.app(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+    assert statuses == ["200 OK"]
+    assert all(type(chunk) is bytes for chunk in chunks)
+    assert b"".join(chunks) == bytes(expected)
+
+
+def test_batch_removal_reports_non_string_ids_as_bad_requests(index):
+    headers = {"Authorization": "Bearer " + index.issue_token("admin", "FULL")}
+    response = index.app.test_client().delete("/services/batch", json=[5, None, {}, {"id": "missing"}], headers=headers)
+    assert response.status_code == 207
+    assert [result["status"] for result in response.get_json()["results"]] == [400, 400, 400, 404]
@@ -0,0 +1,403 @@
+import os
+import uuid
+
+import pytest
+
+from storage import url_hash
+
+REGISTRY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The MySQL suite runs against its own throwaway database on DB_HOST
+TEST_DB_NAME = os.getenv("TEST_DB_NAME", "registry_test")
+PAST = "2000-01-01 00:00:00.000"
+
+
+def mysql_server():
+    # Returns connection arguments for a reachable server, or skips
+    connector = pytest.importorskip("mysql.connector")
+    args = {
+        "host": os.getenv("DB_HOST", "localhost"),
+        "user": os.getenv("DB_USER", "admin"),
+        "password": os.getenv("DB_PW", "group4"),
+        "port": int(os.getenv("DB_PORT", "3306")),
+    }
+    try:
+        conn = connector.connect(connection_timeout=2, **args)
+    except connector.Error as e:
+        pytest.skip(f"No MySQL server reachable: {e}")
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {TEST_DB_NAME};")
+    cursor.execute(f"CREATE DATABASE {TEST_DB_NAME};")
+    cursor.execute(f"USE {TEST_DB_NAME};")
+    with open(os.path.join(REGISTRY_DIR, "init.sql")) as f:
+        schema = f.read().replace("USE registry_db;", "")
+    for statement in schema.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+    conn.commit()
+    conn.close()
+    return args
+
+
+@pytest.fixture(scope="session")
+def mysql_args():
+    return mysql_server()
+
+
+@pytest.fixture(params=["sqlite", "mysql"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        storage = SQLiteStorage(str(tmp_path / "registry.db"))
+    else:
+        from mysql_storage import MySQLStorage
+        storage = MySQLStorage(
+            pool_size=2,
+            pool_timeout=5,
+            pool_validate_after=30,
+            database=TEST_DB_NAME,
+            **request.getfixturevalue("mysql_args")
+        )
+        with storage.transaction("reset", write=True) as cursor:
+            cursor.execute("DELETE FROM services;")
+            cursor.execute("DELETE FROM catalog_changes;")
+            cursor.execute("DELETE FROM users WHERE write_access = 'SELF';")
+            cursor.execute("UPDATE catalog_state SET revision = 0, compacted_revision = 0 WHERE id = 1;")
+    yield storage
+    storage.close()
+
+
+def registration(name, url, **fields):
+    reg = {
+        "id": str(uuid.uuid4()),
+        "name": name,
+        "description": f"{name} service",
+        "url": url,
+        "ttl": None,
+        "weight": 100,
+        "zone": None,
+        "version": None,
+        "tags": [],
+    }
+    reg.update(fields)
+    return reg
+
+
+def register(storage, *registrations):
+    storage.register_services(list(registrations), ["hash"] * len(registrations))
+    return [reg["id"] for reg in registrations]
+
+
+def services_by_id(storage):
+    return {service["id"]: service for service in storage.fetch_catalog()[1]}
+
+
+def expire(storage, service_id):
+    with storage.transaction("test_expire", write=True) as cursor:
+        cursor.execute("UPDATE services SET expires_at = %s WHERE id = %s;", [PAST, service_id])
+
+
+# Registration
+
+def test_register_creates_service_and_credentials(storage):
+    service_id, = register(storage, registration("flights", "http://flights:5000", tags=["b", "a"]))
+    service = services_by_id(storage)[service_id]
+    assert service["name"] == "flights"
+    assert service["url"] == "http://flights:5000"
+    assert service["status"] == "healthy"
+    assert service["tags"] == ["a", "b"]
+    assert storage.get_user(service_id)["write_access"] == "SELF"
+
+
+def test_register_stores_password_hash_as_text(storage):
+    reg = registration("flights", "http://flights:5000")
+    storage.register_services([reg], ["$2b$12$hash"])
+    assert storage.get_user(reg["id"])["password_hash"] == "$2b$12$hash"
+
+
+def test_register_is_idempotent_on_name_and_url(storage):
+    first, = register(storage, registration("flights", "http://flights:5000", tags=["old"]))
+    again = registration("flights", "http://flights:5000", description="restarted", weight=5, tags=["new"])
+    register(storage, again)
+    assert again["id"] == first
+    services = services_by_id(storage)
+    assert list(services) == [first]
+    assert services[first]["description"] == "restarted"
+    assert services[first]["weight"] == 5
+    assert services[first]["tags"] == ["new"]
+
+
+def test_register_upsert_matches_name_case_insensitively(storage):
+    first, = register(storage, registration("Flights", "http://flights:5000"))
+    again = registration("FLIGHTS", "http://flights:5000")
+    register(storage, again)
+    assert again["id"] == first
+    assert len(services_by_id(storage)) == 1
+
+
+def test_register_folds_repeats_within_one_batch(storage):
+    first = registration("Flights", "http://flights:5000", tags=["old"])
+    repeat = registration("FLIGHTS", "http://flights:5000", tags=["new"])
+    storage.register_services([first, repeat], ["first", "repeat"])
+    assert first["id"] == repeat["id"]
+    services = services_by_id(storage)
+    assert list(services) == [first["id"]]
+    # The last registration wins, as it does for the other fields
+    assert services[first["id"]]["tags"] == ["new"]
+    assert storage.get_user(first["id"])["password_hash"] == "repeat"
+    revision, (upper, changes) = storage.fetch_changes(0, 100)
+    assert [change["op"] for change in changes] == ["register"]
+
+
+def test_register_looks_up_ids_in_chunks(storage):
+    ids = register(storage, *[registration(f"svc{i}", f"http://svc{i}") for i in range(300)])
+    assert len(set(ids)) == 300
+    assert set(services_by_id(storage)) == set(ids)
+
+
+def test_register_keeps_different_urls_apart(storage):
+    ids = register(
+        storage,
+        registration("flights", "http://flights-1:5000"),
+        registration("flights", "http://flights-2:5000")
+    )
+    assert len(set(ids)) == 2
+    assert set(services_by_id(storage)) == set(ids)
+
+
+def test_register_upsert_restores_health(storage):
+    service_id, = register(storage, registration("flights", "http://flights:5000"))
+    storage.update_statuses({"unhealthy": [service_id]})
+    register(storage, registration("flights", "http://flights:5000"))
+    assert services_by_id(storage)[service_id]["status"] == "healthy"
+
+
+# Queries
+
+def test_query_filters_by_name_prefix_and_status(storage):
+    flights, weather, wishlist = register(
+        storage,
+        registration("flights", "http://a"),
+        registration("weather", "http://b"),
+        registration("wishlist", "http://c")
+    )
+    storage.update_statuses({"suspect": [wishlist]})
+    rows, _ = storage.query_services(["name"], name="weather")
+    assert [row["id"] for row in rows] == [weather]
+    rows, _ = storage.query_services(["name"], prefix="w")
+    assert {row["id"] for row in rows} == {weather, wishlist}
+    rows, _ = storage.query_services(["name", "status"], statuses=["healthy"])
+    assert {row["id"] for row in rows} == {flights, weather}
+
+
+def test_query_prefix_escapes_like_wildcards(storage):
+    underscore, _ = register(
+        storage,
+        registration("a_b", "http://a"),
+        registration("axb", "http://b")
+    )
+    rows, _ = storage.query_services(["name"], prefix="a_")
+    assert [row["id"] for row in rows] == [underscore]
+    rows, _ = storage.query_services(["name"], prefix="%")
+    assert rows == []
+
+
+def test_query_pages_with_cursor(storage):
+    ids = register(storage, *[registration(f"svc{i}", f"http://svc{i}") for i in range(5)])
+    seen = []
+    after = None
+    pages = 0
+    while True:
+        rows, after = storage.query_services(["name"], after=after, limit=2)
+        seen.extend(row["id"] for row in rows)
+        pages += 1
+        if after is None:
+            break
+    assert pages == 3
+    assert seen == sorted(ids)
+
+
+def test_query_attaches_tags(storage):
+    service_id, = register(storage, registration("flights", "http://a", tags=["eu", "v2"]))
+    rows, _ = storage.query_services(["name"], tags=True)
+    assert rows[0]["id"] == service_id
+    assert rows[0]["tags"] == ["eu", "v2"]
+
+
+def test_resolve_filters_healthy_instances(storage):
+    east, west, _ = register(
+        storage,
+        registration("flights", "http://east", zone="east", tags=["canary"]),
+        registration("flights", "http://west", zone="west"),
+        registration("weather", "http://weather")
+    )
+    assert [row["id"] for row in storage.resolve_instances("flights")] == sorted([east, west])
+    assert [row["id"] for row in storage.resolve_instances("flights", zone="west")] == [west]
+    assert [row["id"] for row in storage.resolve_instances("flights", tags=["canary"])] == [east]
+    storage.update_statuses({"unhealthy": [east]})
+    assert [row["id"] for row in storage.resolve_instances("flights")] == [west]
+
+
+# Leases
+
+def test_leased_services_are_not_probed(storage):
+    probed, leased = register(
+        storage,
+        registration("flights", "http://a"),
+        registration("weather", "http://b", ttl=30)
+    )
+    assert [row["id"] for row in storage.fetch_probe_targets()] == [probed]
+
+
+def test_renew_lease(storage):
+    leased, probed = register(
+        storage,
+        registration("weather", "http://b", ttl=30),
+        registration("flights", "http://a")
+    )
+    assert storage.renew_lease(leased)
+    # Only leased services can renew
+    assert not storage.renew_lease(probed)
+    assert not storage.renew_lease(str(uuid.uuid4()))
+
+
+def test_expired_leases_are_removed(storage):
+    lapsed, live, probed = register(
+        storage,
+        registration("weather", "http://a", ttl=30),
+        registration("weather", "http://b", ttl=30),
+        registration("flights", "http://c")
+    )
+    expire(storage, lapsed)
+    assert not storage.renew_lease(lapsed)
+    assert [row["id"] for row in storage.resolve_instances("weather")] == [live]
+    assert storage.expire_leases() == [lapsed]
+    assert set(services_by_id(storage)) == {live, probed}
+    assert storage.get_user(lapsed) is None
+    assert storage.expire_leases() == []
+
+
+# Change log
+
+def test_change_log_records_every_write(storage):
+    service_id, = register(storage, registration("flights", "http://a"))
+    storage.update_statuses({"suspect": [service_id]})
+    storage.remove_services([service_id], "deregister")
+    revision, (upper, changes) = storage.fetch_changes(0, 100)
+    assert revision == upper == 3
+    assert storage.fetch_catalog_revision() == 3
+    assert [(change["revision"], change["op"], change["id"]) for change in changes] == [
+        (1, "register", service_id),
+        (2, "status", service_id),
+        (3, "deregister", service_id),
+    ]
+    assert changes[0]["service"]["url"] == "http://a"
+    assert changes[1]["service"] == {"id": service_id, "status": "suspect"}
+    assert "service" not in changes[2]
+
+
+def test_change_log_register_entry_matches_the_stored_row(storage):
+    register(storage, registration("flights", "http://a", tags=["x"]))
+    register(storage, registration("FLIGHTS", "http://a", description="restarted", tags=["y"]))
+    revision, (upper, changes) = storage.fetch_changes(1, 100)
+    service = services_by_id(storage)[changes[0]["id"]]
+    assert service["name"] == "flights"
+    assert changes[0]["service"] == service
+
+
+def test_change_log_pages_by_revision(storage):
+    for i in range(3):
+        register(storage, registration(f"svc{i}", f"http://svc{i}"))
+    revision, (upper, changes) = storage.fetch_changes(0, 2)
+    assert (revision, upper) == (3, 2)
+    assert [change["revision"] for change in changes] == [1, 2]
+    revision, (upper, changes) = storage.fetch_changes(upper, 2)
+    assert upper == 3
+    assert [change["revision"] for change in changes] == [3]
+
+
+def test_change_log_compaction(storage):
+    for i in range(4):
+        register(storage, registration(f"svc{i}", f"http://svc{i}"))
+    removed, compacted = storage.compact_change_log(retention=1)
+    assert (removed, compacted) == (3, 3)
+    # A client behind the compacted revision has to resync
+    assert storage.fetch_changes(0, 100) == (4, None)
+    assert storage.fetch_changes(5, 100) == (4, None)
+    revision, (upper, changes) = storage.fetch_changes(3, 100)
+    assert [change["revision"] for change in changes] == [4]
+
+
+# Deletes
+
+def test_remove_services_returns_existing_ids(storage):
+    first, second = register(
+        storage,
+        registration("flights", "http://a", tags=["eu"]),
+        registration("weather", "http://b")
+    )
+    missing = str(uuid.uuid4())
+    assert storage.remove_services([first, missing], "deregister") == {first}
+    assert set(services_by_id(storage)) == {second}
+    assert storage.get_user(first) is None
+    rows, _ = storage.query_services(["name"], tags=True)
+    assert [row["tags"] for row in rows] == [[]]
+    assert storage.remove_service(first, "deregister") is False
+    assert storage.remove_service(second, "evict") is True
+
+
+def test_compact_orphaned_users(storage):
+    service_id, = register(storage, registration("flights", "http://a"))
+    with storage.transaction("test_orphan", write=True) as cursor:
+        cursor.execute("DELETE FROM services WHERE id = %s;", [service_id])
+    assert storage.compact_orphaned_users() == 1
+    assert storage.get_user(service_id) is None
+    assert storage.get_user("admin")["write_access"] == "FULL"
+
+
+def test_url_hash_matches_stored_column(storage):
+    service_id, = register(storage, registration("flights", "http://a"))
+    with storage.transaction("test_url_hash") as cursor:
+        cursor.execute("SELECT url_hash FROM services WHERE id = %s;", [service_id])
+        assert cursor.fetchone()["url_hash"] == url_hash("http://a")
+
+
+# Schema migration (MySQL only, SQLite databases always had the full schema)
+
+BASELINE_SCHEMA = (
+    "CREATE TABLE services (id CHAR(36) NOT NULL PRIMARY KEY, name VARCHAR(255) NOT NULL, description TEXT, url VARCHAR(2048));",
+    "CREATE TABLE users (username VARCHAR(255) NOT NULL PRIMARY KEY, password_hash VARCHAR(255) NOT NULL, write_access VARCHAR(10) DEFAULT 'NONE');",
+)
+
+
+def test_mysql_migrates_a_baseline_database(mysql_args):
+    import mysql.connector
+    from mysql_storage import MySQLStorage
+
+    database = f"{TEST_DB_NAME}_migrate"
+    conn = mysql.connector.connect(**mysql_args)
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {database};")
+    cursor.execute(f"CREATE DATABASE {database};")
+    cursor.execute(f"USE {database};")
+    for statement in BASELINE_SCHEMA:
+        cursor.execute(statement)
+    # The same instance registered twice, as older releases allowed
+    cursor.executemany(
+        "INSERT INTO services (id, name, description, url) VALUES (%s, %s, '', 'http://a');",
+        [("1", "flights"), ("2", "Flights")]
+    )
+    cursor.executemany("INSERT INTO users VALUES (%s, 'hash', 'SELF');", [("1",), ("2",)])
+    conn.commit()
+    conn.close()
+
+    for _ in range(2):
+        storage = MySQLStorage(pool_size=1, pool_timeout=5, pool_validate_after=30, database=database, **mysql_args)
+        try:
+            assert [service["id"] for service in storage.fetch_catalog()[1]] == ["1"]
+            assert storage.get_user("2") is None
+            again = registration("FLIGHTS", "http://a", tags=["eu"])
+            register(storage, again)
+            assert again["id"] == "1"
+            assert storage.fetch_changes(0, 100)[1][1][0]["service"]["tags"] == ["eu"]
+        finally:
+            storage.close()